@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+Latency and throughput benchmark of the control protocol of the button pusher.
+The slave runs in-process with the simulated motor and IQR of gpiobackend, and is driven over the
+loopback interface by protocol.Channel clients. The measures are:
+    - ack:          request to "press start" latency of the long press, short press and free move
+    - abort:        abort request to the final reply of the aborted press
+    - status:       latency of the read-only status query, alone and during a press
+    - concurrency:  status latency with N clients polling at once while a press runs
+    - throughput:   sustained rate of pipelined 1-step free moves and of pipelined status queries
+    - jitter:       per-phase timing error of the moves on the real clock, as recorded by the
+                    slave and as seen by the simulated motor
+    - final:        time to the final power status of each mode and of a power cycle, on the
+                    virtual clock with the default model of the IQR
+The results are written to a JSON file to compare two revisions of the slave.
+Usage: python3 benchmark.py [-o benchmark.json] [-n 20] [--clients 1,4,16]
+'''
+
+import argparse, asyncio, json, logging, math, platform, subprocess, threading, time
+
+import protocol, gpiobackend
+import buttonPusher_Slave as slave
+from clock import Clock, VirtualClock
+
+
+def summary(samples):
+    '''
+    statistics of latencies in seconds, reported in milliseconds
+    '''
+    samples = sorted(samples)
+    if not samples:
+        return {"n": 0}
+    def pick(q):
+        return round(samples[max(math.ceil(q * len(samples)) - 1, 0)] * 1e3, 3)
+    return {"n": len(samples), "min": pick(0), "mean": round(sum(samples) / len(samples) * 1e3, 3),
+            "p50": pick(0.5), "p99": pick(0.99), "max": pick(1)}
+
+
+def waitFor(channel, msgid, event=None):
+    '''
+    read until the event (or the final reply if None) of the request msgid, return the message
+    '''
+    while True:
+        msg = channel.recv()
+        if msg is None:
+            raise ConnectionError("connection closed by the slave")
+        if msg["id"] != msgid:
+            continue
+        if event is None and msg["type"] == protocol.REPLY:
+            return msg
+        if event is not None and msg["type"] == protocol.EVENT and msg["event"] == event:
+            return msg
+
+
+class LoopbackSlave():
+    '''
+    slave on the real clock with the simulated motor, served on an ephemeral loopback port
+    '''
+    def __init__(self):
+        self.clock = Clock()
+        self.backend = gpiobackend.SimBackend(self.clock)
+        self.iqr = gpiobackend.SimIQR(self.backend, on=True, bootTime=1., shutdownTime=0.5)
+        self.control = slave.PusherController(self.backend, clock=self.clock)
+        self.control.setup()
+        iqrStatus = slave.powerCheck(prober=gpiobackend.SimProber(self.iqr, timeout=0.05))
+        self.server = slave.ControlServer("127.0.0.1", 0, logging.getLogger("socket"), [slave.Pusher("default", self.control, iqrStatus)],
+                handleSignals=False)
+        self.thread = threading.Thread(target=self.clock.run, args=(self.server.serve(),), daemon=True)
+        self.thread.start()
+        if not self.server.listening.wait(10):
+            raise RuntimeError("the slave did not start")
+
+    def connect(self):
+        return protocol.Channel("127.0.0.1", self.server.port, timeout=60)
+
+    def close(self):
+        channel = self.connect()
+        waitFor(channel, channel.send(protocol.CMD_KILL))
+        channel.disconnect()
+        self.thread.join(10)
+
+
+def benchAck(bench, n):
+    channel = bench.connect()
+    ack, abort = {}, []
+    for name, cmd, args in (("long", protocol.CMD_PRESS, {"mode": "long"}),
+                            ("short", protocol.CMD_PRESS, {"mode": "short"}),
+                            ("move", protocol.CMD_MOVE, {"direction": "forward", "steps": 1})):
+        samples = []
+        for i in range(n):
+            start = time.perf_counter()
+            msgid = channel.send(cmd, **args)
+            waitFor(channel, msgid, protocol.EVENT_PRESS)
+            samples.append(time.perf_counter() - start)
+            if cmd == protocol.CMD_PRESS:
+                # cut the press short, the rod goes back home
+                start = time.perf_counter()
+                channel.send(protocol.CMD_ABORT)
+                waitFor(channel, msgid)
+                abort.append(time.perf_counter() - start)
+            else:
+                waitFor(channel, msgid)
+                waitFor(channel, channel.send(protocol.CMD_MOVE, direction="backward", steps=1))
+        ack[name] = summary(samples)
+    channel.disconnect()
+    return ack, summary(abort)
+
+
+def statusLatency(bench, n, results, index):
+    channel = bench.connect()
+    samples = []
+    for i in range(n):
+        start = time.perf_counter()
+        waitFor(channel, channel.send(protocol.CMD_STATUS))
+        samples.append(time.perf_counter() - start)
+    channel.disconnect()
+    results[index] = samples
+
+
+def benchStatus(bench, n, clients):
+    results = {}
+    samples = [None]
+    statusLatency(bench, n, samples, 0)
+    results["idle"] = summary(samples[0])
+    for count in clients:
+        # a long press keeps the motor queue busy while the clients poll
+        presser = bench.connect()
+        msgid = presser.send(protocol.CMD_PRESS, mode="long")
+        waitFor(presser, msgid, protocol.EVENT_PRESS)
+        samples = [None] * count
+        threads = [threading.Thread(target=statusLatency, args=(bench, n, samples, i)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        presser.send(protocol.CMD_ABORT)
+        waitFor(presser, msgid)
+        presser.disconnect()
+        results["{:d} clients during a press".format(count)] = summary([s for client in samples for s in client])
+    return results
+
+
+def benchThroughput(bench, n):
+    channel = bench.connect()
+    results = {}
+    # pipelined free moves, back and forth around the starting point
+    start = time.perf_counter()
+    ids = [channel.send(protocol.CMD_MOVE, direction="forward" if i % 2 == 0 else "backward", steps=1) for i in range(2 * n)]
+    for msgid in ids:
+        waitFor(channel, msgid)
+    results["moves per second"] = round(len(ids) / (time.perf_counter() - start), 2)
+    # pipelined read-only queries
+    start = time.perf_counter()
+    ids = [channel.send(protocol.CMD_STATUS) for i in range(50 * n)]
+    for msgid in ids:
+        waitFor(channel, msgid)
+    results["status queries per second"] = round(len(ids) / (time.perf_counter() - start), 2)
+    channel.disconnect()
+    return results
+
+
+def benchJitter(bench, n):
+    channel = bench.connect()
+    first = len(bench.backend.transitions)
+    for i in range(n):
+        waitFor(channel, channel.send(protocol.CMD_MOVE, direction="forward" if i % 2 == 0 else "backward", steps=5))
+    moves = waitFor(channel, channel.send(protocol.CMD_JITTER))["data"]["moves"][-n:]
+    channel.disconnect()
+    # pause between two phases of a move as seen by the motor, against the 5 ms of the free mode
+    nominal = 1 / slave.MOTION_PROFILES["free"].maxRate
+    errors, previous = [], None
+    for now, state in bench.backend.transitions[first:]:
+        if state == (0, 0, 0, 0):
+            previous = None
+            continue
+        if previous is not None:
+            errors.append(abs((now - previous) / 1e9 - nominal))
+        previous = now
+    # the slave records the jitter in microseconds
+    return {"recorded p99": summary([m["p99"] / 1e6 for m in moves]),
+            "recorded max": summary([m["max"] / 1e6 for m in moves]),
+            "phase interval error": summary(errors)}
+
+
+async def virtualRun(clock, cmd, args, on):
+    backend = gpiobackend.SimBackend(clock)
+    iqr = gpiobackend.SimIQR(backend, on=on)
+    control = slave.PusherController(backend, clock=clock)
+    control.setup()
+    pusher = slave.Pusher("default", control, slave.powerCheck(prober=gpiobackend.SimProber(iqr)))
+    server = slave.ControlServer("127.0.0.1", 0, logging.getLogger("socket"), [pusher], handleSignals=False)
+    serving = asyncio.ensure_future(server.serve())
+    while not server.listening.is_set():
+        await asyncio.sleep(0.01)
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    protocol.writeMessage(writer, protocol.request(1, cmd, **args))
+    while True:
+        msg = await protocol.readMessage(reader)
+        if msg["type"] == protocol.REPLY:
+            break
+    elapsed = loop.time() - start
+    protocol.writeMessage(writer, protocol.request(2, protocol.CMD_KILL))
+    await serving
+    writer.close()
+    return {"seconds": round(elapsed, 3), "ok": msg["ok"], "power": msg["data"].get("power"),
+            "transition": msg["data"].get("transition"), "lost steps": backend.lostSteps}
+
+
+def benchFinal():
+    results = {}
+    for name, cmd, args, on in (("long press", protocol.CMD_PRESS, {"mode": "long"}, True),
+                                ("short press", protocol.CMD_PRESS, {"mode": "short"}, False),
+                                ("move", protocol.CMD_MOVE, {"direction": "forward", "steps": 5}, True),
+                                ("power cycle", protocol.CMD_SEQUENCE, {"macro": "powercycle"}, True)):
+        start = time.perf_counter()
+        clock = VirtualClock()
+        results[name] = clock.run(virtualRun(clock, cmd, args, on))
+        results[name]["real seconds"] = round(time.perf_counter() - start, 3)
+    return results
+
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="latency and throughput benchmark of the button pusher")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="JSON file of the results")
+    parser.add_argument("-n", "--iterations", type=int, default=20, help="repetitions of every measure")
+    parser.add_argument("--clients", default="1,4,16", help="numbers of concurrent clients, comma separated")
+    args = parser.parse_args()
+    clients = [int(count) for count in args.clients.split(",")]
+    # the warnings of the aborted presses are expected
+    logging.basicConfig(level=logging.ERROR)
+
+    results = {}
+    bench = LoopbackSlave()
+    try:
+        results["ack"], results["abort"] = benchAck(bench, args.iterations)
+        results["status"] = benchStatus(bench, args.iterations, clients)
+        results["throughput"] = benchThroughput(bench, args.iterations)
+        results["jitter"] = benchJitter(bench, args.iterations)
+    finally:
+        bench.close()
+    results["final"] = benchFinal()
+
+    report = {
+            "meta": {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "revision": revision(),
+                "python": platform.python_version(), "platform": platform.platform(),
+                "iterations": args.iterations, "clients": clients},
+            "results": results,
+            }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print("results written to {}".format(args.output))
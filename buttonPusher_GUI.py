@@ -5,28 +5,74 @@ from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 
-import socket, sys, time
-from multithread import Worker, WorkerSignals
-
-class ControlClient():
-    def __init__(self, IP, port):
-        self.IP = IP
-        self.port = port
-        self.connect()
-    
-    def connect(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((self.IP, self.port))
-
-    def disconnect(self):
-        self.sock.close()
-
-    def write(self, cmd):
-        self.sock.send(cmd.encode("utf-8"))
-
-    def read(self):
-        data = self.sock.recv(4096)
-        return data.decode("utf-8").strip()
+import sys
+import protocol, connection
+
+# the slave, and the timeouts of the connection in seconds
+SLAVE_IP = "10.10.91.96"
+SLAVE_PORT = 5052
+CONNECT_TIMEOUT = 3.
+HEARTBEAT = 2.
+DEAD_TIMEOUT = 6.
+
+class ControlClient(QObject):
+    '''
+    any number of requests in flight on one connection to the slave: the reader thread of the
+    connection hands every message over to the GUI thread, where it is dispatched by request id
+    to the callbacks of its request
+    '''
+    state    = pyqtSignal(str, str)             # state of the connection, detail
+    power    = pyqtSignal(str)                  # "on" | "off", from a reply or a power event
+    restored = pyqtSignal("PyQt_PyObject")      # data of the init reply of every new connection
+    message  = pyqtSignal("PyQt_PyObject")
+
+    def __init__(self, IP, port, **options):
+        super().__init__()
+        # request id: (onEvent, onReply)
+        self.requests = {}
+        self.message.connect(self.dispatch)
+        self.connection = connection.Connection(IP, port, onState=self.state.emit, onMessage=self.message.emit, **options)
+
+    def start(self):
+        self.connection.start()
+        return self
+
+    def close(self):
+        self.connection.disconnect()
+
+    @property
+    def connected(self):
+        return self.connection.connected
+
+    def request(self, cmd, onEvent=None, onReply=None, **args):
+        '''
+        send a request, return its id; raise ConnectionError if the slave is not connected
+        onEvent:    called with (event, data) of every event of the request
+        onReply:    called with (ok, data, error) of its reply, which always comes
+        '''
+        msgid = self.connection.send(cmd, **args)
+        # the messages of the request are dispatched in this thread, after it returns
+        self.requests[msgid] = (onEvent, onReply)
+        return msgid
+
+    def dispatch(self, msg):
+        if msg["type"] == protocol.EVENT and msg["event"] == protocol.EVENT_POWER:
+            self.power.emit(msg["data"]["power"])
+        handlers = self.requests.get(msg["id"])
+        if handlers is None:
+            if msg["type"] == protocol.REPLY and msg["ok"] and "position" in msg["data"]:
+                self.restored.emit(msg["data"])
+            return
+        onEvent, onReply = handlers
+        if msg["type"] == protocol.EVENT:
+            if onEvent is not None:
+                onEvent(msg["event"], msg["data"])
+        elif msg["type"] == protocol.REPLY:
+            del self.requests[msg["id"]]
+            if msg["ok"] and "power" in msg["data"]:
+                self.power.emit(msg["data"]["power"])
+            if onReply is not None:
+                onReply(msg["ok"], msg["data"], msg.get("error"))
 
 
 class MainWindow(QMainWindow):
@@ -40,14 +86,16 @@ class MainWindow(QMainWindow):
         self.height = 200
 
         # the default parameters
-        self.workMode = "2"     # default workMode: short press
+        self.workMode = "short" # default workMode: short press
         self.step = "5"         # default steps of movement(free mode): 5
-        self.direct = "1"       # default direction of movement(free mode): forward
-        self.stepDiff = 0       # step difference with the starting point
+        self.direct = "forward" # default direction of movement(free mode): forward
+        self.stepDiff = 0       # step difference with home, as kept by the slave
 
         # the default operation parameters
         self.hide = True
         self.exit = False
+        self.running = False
+        self.error = None
 
         # the default color setting
         self.bgcolor = "#FAFAFA"
@@ -142,8 +190,6 @@ class MainWindow(QMainWindow):
         self.setGeometry(self.left, self.top, self.width, self.height)
         self.setStyleSheet("QLabel{{color: {0:s} }} QRadioButton{{background-color: {1:s}; color: {0:s}}} QTextEdit{{color: {0:s}}} QMainWindow{{ background-color: {1:s} }} QCentralWidget{{ background-color: {1:s} }} QGroupBox{{ background-color: {1:s} }}".format(self.fgcolor, self.bgcolor))
 
-        self.threadPool = QThreadPool()
-
         self.setDisplayPanel()
         self.buildConnection()
 
@@ -234,10 +280,10 @@ class MainWindow(QMainWindow):
         def check_mode(b):
             if b.text() == "turn on " and b.isChecked() == True:
                 self.statusBar().showMessage("turn on the IQ recorder")
-                self.workMode = "2"
+                self.workMode = "short"
             if b.text() == "turn off" and b.isChecked() == True:
                 self.statusBar().showMessage("turn off the IQ recorder")
-                self.workMode = "1"
+                self.workMode = "long"
         self.modeShortButton.toggled.connect(lambda:check_mode(self.modeShortButton))
         self.modeLongButton.toggled.connect(lambda:check_mode(self.modeLongButton))
 
@@ -245,9 +291,9 @@ class MainWindow(QMainWindow):
         def button_direction(b):
             if self.invisiablePanel.isVisible():
                 if b.text() == "forward" and b.isChecked() == True:
-                    self.direct = "1"
+                    self.direct = "forward"
                 if b.text() == "backward" and b.isChecked() == True:
-                    self.direct = "2"
+                    self.direct = "backward"
             else:
                 return
         self.operatForwardButton.toggled.connect(lambda:button_direction(self.operatForwardButton))
@@ -257,68 +303,73 @@ class MainWindow(QMainWindow):
         def button_status():
             if self.statusButton.isChecked():
                 if not self.invisiablePanel.isVisible():
-                    self.current_worker = Worker(Press_work, self.workMode)
-                    self.current_worker.signals.finished.connect(ready)
-                    self.current_worker.signals.progress.connect(process)
-                    self.current_worker.signals.result.connect(result)
-                    self.statusButton.setEnabled(False)
-                    self.threadPool.start(self.current_worker)
+                    cmd, args = protocol.CMD_PRESS, {"mode": self.workMode}
                 else:
                     self.step = self.stepInput.text()
-                    if int(self.step) <= 0:
-                        self.statusBar.showMessage("step input invaild! input again...")
+                    try:
+                        steps = int(self.step)
+                    except ValueError:
+                        steps = 0
+                    if steps <= 0:
+                        self.statusButton.setChecked(False)
+                        self.statusBar().showMessage("step input invaild! input again...")
                         return
-                    self.current_worker = Worker(Debug_work, self.direct, self.step, self.stepDiff)
-                    self.current_worker.signals.finished.connect(ready)
-                    self.current_worker.signals.progress.connect(process)
-                    self.current_worker.signals.result.connect(result)
-                    self.statusButton.setEnabled(False)
+                    cmd, args = protocol.CMD_MOVE, {"direction": self.direct, "steps": steps}
+                try:
+                    self.control.request(cmd, onEvent=progress, onReply=finished, **args)
+                except ConnectionError as e:
+                    self.statusButton.setChecked(False)
+                    self.statusBar().showMessage(str(e))
+                    return
+                self.statusButton.setEnabled(False)
+                self.running = True
+                if cmd == protocol.CMD_MOVE:
                     self.QLineEdit_RunStyle(self.stepInput)
-                    self.threadPool.start(self.current_worker)
                 self.statusBar().showMessage("start press!")
         self.statusButton.setCheckable(True)
         self.statusButton.toggled.connect(button_status)
         self.statusButton.setEnabled(False)
 
-        # short/long press work
-        def Press_work(mode, stdscr):
-            self.control.write(mode)
-            while True:
-                msg = self.control.read()
-                stdscr.emit(int(msg))
-                if msg == "10" or msg == "11":
-                    break
-            return self.stepDiff
-        # free press work
-        def Debug_work(direction, step, stepDiff, stdscr):
-            self.control.write("3")
-            time.sleep(0.05)
-            self.control.write(direction + "," + step)
-            while True:
-                msg = self.control.read()
-                stdscr.emit(int(msg))
-                if msg == "10" or msg == "11":
-                    break
-            if direction == "1":
-                return (stepDiff + int(step))
-            else:
-                return (stepDiff - int(step))
-        def process(percentVal):
-            if percentVal == 0:
+        # the events and the reply of the running press or movement
+        def progress(event, data):
+            if event == protocol.EVENT_PRESS and data.get("state") == "stop":
                 self.statusButton.setChecked(False)
                 self.statusBar().showMessage("end press!")
-            elif percentVal == 10:
+            elif event == protocol.EVENT_PROGRESS:
+                # the bar follows the rod during a motion and counts down a hold or a wait
+                if "steps" in data:
+                    self.IQRstatus.setValue(int(100 * data["step"] / data["steps"]))
+                    self.IQRstatus.setFormat("{} {:g}/{:g}".format(data["stage"], data["step"], data["steps"]))
+                elif "remaining" in data:
+                    self.IQRstatus.setValue(int(100 * data["remaining"] / data["duration"]) if data["duration"] else 0)
+                    self.IQRstatus.setFormat("{} {:.1f} s".format(data["stage"], data["remaining"]))
+                if "power" in data:
+                    self.IQRstatus.setStyleSheet(self.on_style if data["power"] == "on" else self.off_style)
+                    self.IQRstatusLab.setText("IQR Power" if data["rtt"] is None else "IQR Power {:g} ms".format(data["rtt"]))
+        def finished(ok, data, error):
+            if ok:
+                result(data["position"])
+            else:
+                self.error = error
+                self.statusButton.setChecked(False)
+            ready()
+        def show_power(power):
+            self.IQRstatus.setValue(100)
+            if power == "off":
                 self.IQRstatus.setStyleSheet(self.off_style)
                 self.IQRstatus.setFormat("off")
-            elif percentVal == 11:
+            else:
                 self.IQRstatus.setStyleSheet(self.on_style)
                 self.IQRstatus.setFormat("on")
-            else:
-                pass
         def ready():
-            self.statusButton.setEnabled(True)
+            self.running = False
+            self.statusButton.setEnabled(self.control.connected)
             self.QLineEdit_StopStyle(self.stepInput)
-            self.statusBar().showMessage("operation ends")
+            if self.error is None:
+                self.statusBar().showMessage("operation ends")
+            else:
+                self.statusBar().showMessage("operation failed: {}".format(self.error))
+                self.error = None
             if self.hide:
                 if self.invisiablePanel.isVisible():
                     self.invisiablePanel.setVisible(False)
@@ -337,30 +388,44 @@ class MainWindow(QMainWindow):
                     self.statusBar().showMessage("show the free mode")
             if self.exit:
                 self.statusBar().showMessage("exit the controller")
-                self.control.disconnect()
+                self.control.close()
                 sys.exit()
         def result(stepDiff):
             self.stepDiff = stepDiff
             if self.stepDiff <= 0:
-                self.stepChange.setText(str(self.stepDiff))
+                self.stepChange.setText("{:g}".format(self.stepDiff))
+            else:
+                self.stepChange.setText("+{:g}".format(self.stepDiff))
+
+        # the connection to the slave, kept up in the background
+        def connection_state(state, detail):
+            if state == connection.CONNECTED:
+                self.statusBar().showMessage("connected to the slave")
+            elif state == connection.CONNECTING:
+                self.statusBar().showMessage("connecting to the slave...")
             else:
-                self.stepChange.setText("+" + str(self.stepDiff))
-
-        # intial the client
-        def client_init(stdscr):
-            self.control = ControlClient("10.10.91.96", 5052)
-            self.control.write("init")
-            msg = self.control.read()
-            stdscr.emit(int(msg))
-        client_worker = Worker(client_init)
-        client_worker.signals.progress.connect(process)
-        client_worker.signals.finished.connect(ready)
-        self.statusBar().showMessage("waiting for connecting...")
-        self.threadPool.start(client_worker)
+                self.statusBar().showMessage("disconnected: {}".format(detail))
+                self.IQRstatus.setStyleSheet(self.init_style)
+                self.IQRstatus.setFormat("waiting")
+            self.statusButton.setEnabled(state == connection.CONNECTED and not self.running)
+        def restore(data):
+            # the reply of the init sent on every new connection, the slave keeps the position of the rod
+            show_power(data["power"])
+            result(data["position"])
+            # the power changes are pushed by the slave from now on, even during a press
+            try:
+                self.control.request(protocol.CMD_SUBSCRIBE)
+            except ConnectionError:
+                pass
+        self.control = ControlClient(SLAVE_IP, SLAVE_PORT, connectTimeout=CONNECT_TIMEOUT, heartbeat=HEARTBEAT, deadTimeout=DEAD_TIMEOUT)
+        self.control.state.connect(connection_state)
+        self.control.power.connect(show_power)
+        self.control.restored.connect(restore)
+        self.control.start()
 
     def keyPressEvent(self, event):
         if event.modifiers() == Qt.ControlModifier and event.key() == Qt.Key_H:
-            if self.statusButton.isEnabled():
+            if not self.running:
                 if self.invisiablePanel.isVisible():
                     self.hide = True
                     self.invisiablePanel.setVisible(False)
@@ -387,21 +452,32 @@ class MainWindow(QMainWindow):
         elif event.modifiers() == Qt.ControlModifier and event.key() == Qt.Key_W:
             reply = QMessageBox.question(self, "Message", "Are you sure to quit?")
             if reply == QMessageBox.Yes:
-                if self.statusButton.isEnabled():
+                if not self.running:
                     self.statusBar().showMessage("exit the controller")
-                    self.control.disconnect()
+                    self.control.close()
                     sys.exit()
                 else:
                     self.exit = True
                     self.statusBar().showMessage("exit after finished!")
             else:
                 return
-        elif event.modifiers() == Qt.ControlModifier and event.key() == Qt.Key_X and self.statusButton.isEnabled():
+        elif event.modifiers() == Qt.ControlModifier and event.key() == Qt.Key_A and self.running:
+            # the running operation stops within one coil phase and the rod goes back to the starting point
+            try:
+                self.control.request(protocol.CMD_ABORT, onReply=lambda ok, data, error:
+                        self.statusBar().showMessage("aborting, the rod goes back" if data.get("aborted") else "nothing to abort"))
+                self.statusBar().showMessage("abort the operation...")
+            except ConnectionError as e:
+                self.statusBar().showMessage("abort failed: {}".format(e))
+        elif event.modifiers() == Qt.ControlModifier and event.key() == Qt.Key_X and not self.running:
             reply = QMessageBox.question(self, "Message", "Are you sure to quit both controller and raspberry slave?")
             if reply == QMessageBox.Yes:
                 self.statusBar().showMessage("exit the controller")
-                self.control.write("kill")
-                self.control.disconnect()
+                try:
+                    self.control.request(protocol.CMD_KILL)
+                except ConnectionError:
+                    pass
+                self.control.close()
                 sys.exit()
             else:
                 return
@@ -412,7 +488,7 @@ class MainWindow(QMainWindow):
         reply = QMessageBox.question(self, "Message", "Are you sure to force quit?")
         if reply == QMessageBox.Yes:
             self.statusBar().showMessage("exit the controller")
-            self.control.disconnect()
+            self.control.close()
             sys.exit()
         else:
             event.ignore()
@@ -16,241 +16,1056 @@ Operation mode:
         select the direction of movement and step
 """
 
-import RPi.GPIO as GPIO
-import time, readline, subprocess,socket, signal, logging
+import time, readline, signal, logging, asyncio, threading, argparse, bisect, itertools
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import protocol, motion, probe, gpiobackend, metrics, logpipe, journal, motionproc, calibration, devices
+from clock import Clock
 
+# log file, written by a background thread and rotated at 5 MB or every week, 4 old files kept
+LOG_FILE        = __file__[:-2] + 'log'
+LOG_MAX_BYTES   = 5 * 2**20
+LOG_INTERVAL    = 7 * 86400
+LOG_BACKUPS     = 4
+# records waiting to be written, the next ones are dropped instead of blocking the slave
+LOG_QUEUE       = 10000
+# the motions are played by a real-time worker process pinned to this CPU (None for the last one)
+MOTION_CPU      = None
+MOTION_PRIORITY = 50
+# registry of the pushers of the slave, the single pusher on pins 11/12/13/15 without it
+DEVICES_FILE = __file__[:-2] + 'devices.json'
+# journal of the position of the rod of each device, restored at boot
+POSITION_JOURNAL = __file__[:-2] + '{}.position'
+
+# velocity profile of the press modes and of the free mode in coil phases per second
+# 200 phases/s is the former fixed pause of 5 ms per phase, kept for the free mode used for calibration
+MOTION_PROFILES = {
+        "press":    motion.MotionProfile(startRate=200, maxRate=400, accel=8000),
+        "free":     motion.MotionProfile(startRate=200, maxRate=200, accel=8000),
+        }
+DIRECTIONS = {"forward": motion.FORWARD, "backward": motion.BACKWARD}
+# longest hold time of the press modes in seconds, the button is released as soon as the IQR
+# reaches the new state, but never before the shortest hold time
+PRESS_HOLD = {"long": 6, "short": 0.5}
+PRESS_MIN_HOLD = {"long": 2, "short": 0.2}
+# during a hold the IQR is probed every HOLD_POLL seconds with a short timeout, and the new state
+# must be seen by HOLD_CONFIRM consecutive probes
+HOLD_POLL = 0.1
+HOLD_PROBE_TIMEOUT = 0.2
+HOLD_CONFIRM = 2
+# travel of the rod in a press
+PRESS_STEPS = 20
+
+# calibrated press of each device, replacing MOTION_PROFILES["press"] and PRESS_STEPS once saved
+PROFILE_FILE = __file__[:-2] + 'profile.json'
+# travels in steps and cruise rates in phases per second tried by the calibration, from the safest
+CALIBRATION_TRAVELS = tuple(range(PRESS_STEPS, 0, -1))
+CALIBRATION_RATES = (200, 250, 300, 400, 500, 600, 700, 800, 1000)
+# consecutive successes needed to accept a value with each signal
+CALIBRATION_REPEATS = {"switch": 5, "iqr": 2}
+# seconds the IQR has to reach the new state in a trial
+CALIBRATION_TIMEOUT = {"off": 30, "on": 120}
+# the calibrated rate is slowed down by this factor and the travel lengthened by these steps, up to PRESS_STEPS
+RATE_MARGIN = 0.8
+TRAVEL_MARGIN = 2
+# seconds given to each IQR by the sweep command, and the IQRs probed at once
+SWEEP_TIMEOUT = 1.
+SWEEP_CONCURRENCY = 32
+# seconds between two progress events of a running operation to a client, and the bytes waiting to
+# be sent to a client above which its progress events are held back, the latest one replacing the others
+PROGRESS_INTERVAL = 0.2
+PROGRESS_BUFFER = 16 * 1024
+# seconds after the end of an operation during which a request of the same intent (a press of the
+# same mode, the same macro) gets its reply instead of running again, as long as no other operation
+# was queued in between (an ensure of the same state only attaches while waiting or running), and
+# during which the reply of an operation requested with an idempotency key is kept for its retries
+COALESCE_WINDOW = 10.
+IDEMPOTENCY_TTL = 300.
+# number of motions whose timing is kept for the jitter query
+JITTER_HISTORY = 50
+
+# workflows run in one request by the sequence command, each step is one of
+#   {"op": "press", "mode": "long" | "short"}
+#   {"op": "move", "direction": "forward" | "backward", "steps": int}
+#   {"op": "wait", "power": "on" | "off", "timeout": seconds (optional)}
+#   {"op": "delay", "seconds": float}
+MACROS = {
+        "powercycle": [
+            {"op": "press", "mode": "long"},
+            {"op": "wait", "power": "off"},
+            {"op": "delay", "seconds": 10},
+            {"op": "press", "mode": "short"},
+            {"op": "wait", "power": "on"},
+            ],
+        }
+
+# metrics of the slave, served in the Prometheus text format and by the stats command
+PRESSES         = metrics.Counter("pusher_presses_total", "presses of the button", ("device", "mode"))
+PRESS_DURATION  = metrics.Histogram("pusher_press_duration_seconds", "time from the start of a press to the rod back home", ("device", "mode"),
+        buckets=(0.25, 0.5, 1, 2, 4, 6, 8, 10, 15))
+HOLD_TIME       = metrics.Histogram("pusher_hold_seconds", "time the button was held in a press", ("device", "mode"),
+        buckets=(0.2, 0.3, 0.5, 1, 2, 3, 4, 5, 6))
+PHASE_LATENESS  = metrics.Histogram("pusher_phase_lateness_seconds", "lateness of the coil phases behind their deadlines", ("device",),
+        buckets=(1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3))
+PHASE_OVERRUNS  = metrics.Counter("pusher_phase_overruns_total", "coil phases later than a whole pause", ("device",))
+TRANSITIONS     = metrics.Histogram("iqr_transition_seconds", "time for the IQR to reach the new power state", ("device", "power"),
+        buckets=(1, 2, 5, 10, 20, 30, 45, 60, 90, 120, 180))
+TRANSITION_TIMEOUTS = metrics.Counter("iqr_transition_timeouts_total", "waits for a power change which timed out", ("device", "power"))
+CLIENTS         = metrics.Gauge("pusher_clients", "connected controllers")
+QUEUE_DEPTH     = metrics.Gauge("pusher_queue_depth", "motor operations waiting in the queue", ("device",))
+COALESCED       = metrics.Counter("pusher_coalesced_requests_total", "requests answered without a new operation: key, intent or noop",
+        ("device", "reason"))
+SOCKET_ERRORS   = metrics.Counter("pusher_socket_errors_total", "errors on the client connections: protocol, request or connection", ("kind",))
+
+
+class ClientConnection():
+    """
+    one connected controller (GUI, CLI monitor, scripts...)
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info("peername")
+        # latest progress event of every device not sent yet, and the timer sending them
+        self.latest = {}
+        self.flushing = None
+        self.flushed = 0.
+
+    @property
+    def closed(self):
+        return self.writer.is_closing()
+
+    def send(self, msg):
+        # a client may hang up in the middle of a press, the motion goes on anyway
+        if not self.closed:
+            protocol.writeMessage(self.writer, msg)
+
+    def progress(self, key, msg):
+        '''
+        send the progress event msg of key (a device, or a device and a request) at most every PROGRESS_INTERVAL seconds,
+        a later event of the same key replaces it until then
+        '''
+        self.latest[key] = msg
+        if self.flushing is None:
+            loop = asyncio.get_running_loop()
+            self.flushing = loop.call_later(max(self.flushed + PROGRESS_INTERVAL - loop.time(), 0), self.flush)
+
+    def flush(self):
+        loop = asyncio.get_running_loop()
+        self.flushing = None
+        if self.closed:
+            self.latest.clear()
+            return
+        if self.writer.transport.get_write_buffer_size() > PROGRESS_BUFFER:
+            # a slow client, it gets the latest state once it has read what it was sent
+            self.flushing = loop.call_later(PROGRESS_INTERVAL, self.flush)
+            return
+        for msg in self.latest.values():
+            self.send(msg)
+        self.latest.clear()
+        self.flushed = loop.time()
+
+    async def read(self):
+        return await protocol.readMessage(self.reader)
+
+    def close(self):
+        if self.flushing is not None:
+            self.flushing.cancel()
+        self.writer.close()
+
+
+class Attached():
+    """
+    the requests answered by one motor operation: the one which started it, and the duplicates
+    attached to it later, each receiving the events and the reply under its own id
+    """
+    def __init__(self, client, msgid):
+        self.requests = [(client, msgid)]
+        # final reply, and the time it was sent
+        self.reply = None
+        self.done = None
+
+    def attach(self, client, msgid):
+        if self.reply is not None:
+            client.send(self.rewrite(self.reply, msgid, True))
+        else:
+            self.requests.append((client, msgid))
+
+    @staticmethod
+    def rewrite(msg, msgid, duplicate):
+        msg = dict(msg, id=msgid)
+        if duplicate and msg["type"] == protocol.REPLY:
+            msg["data"] = dict(msg["data"], coalesced=True)
+        return msg
+
+    def send(self, msg):
+        if msg["type"] == protocol.REPLY:
+            self.reply = msg
+            self.done = asyncio.get_running_loop().time()
+        for index, (client, msgid) in enumerate(self.requests):
+            client.send(self.rewrite(msg, msgid, index > 0))
+
+    def progress(self, key, msg):
+        for index, (client, msgid) in enumerate(self.requests):
+            # a client attached twice gets the events of both its requests
+            client.progress(key if index == 0 else (key, msgid), dict(msg, id=msgid))
 
-logging.basicConfig(
-        level       = logging.INFO,
-        format      = '%(asctime)s %(name)-5s %(message)s',
-        datefmt     = '%Y-%m-%d %H:%M:%S',
-        filename    = __file__[:-2] + 'log',
-        filemode    = 'a'
-        )
 
 class ControlServer():
-    def __init__(self, IP, port, logger):
+    """
+    asyncio server accepting any number of concurrent controllers
+    the commands address a pusher by its name, the default one if they give none; the motor operations
+    of each pusher go through its own queue and are executed one at a time, while the pushers move at
+    the same time and read-only queries (power status) are answered at once
+    pushers:    Pusher of every device of the slave
+    default:    name of the pusher of the commands without a device, the first one by default
+    """
+    def __init__(self, IP, port, logger, pushers, default=None, handleSignals=True, metricsPort=None):
         self.IP = IP
         self.port = port
+        self.pushers = {pusher.name: pusher for pusher in pushers}
+        self.default = pushers[0].name if default is None else default
+        # port of the Prometheus endpoint, None to serve the metrics only by the stats command
+        self.metricsPort = metricsPort
+        # signals can only be handled by a loop in the main thread
+        self.handleSignals = handleSignals
+        # set once the server accepts connections, self.port is then the bound port
+        self.listening = threading.Event()
         self.logger = logger
-        self.connect()
-    
-    def connect(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.bind((self.IP, self.port))
-        self.sock.listen(5)
+        self.clients = set()
+        self.handlers = set()
+        # clients receiving the power events
+        self.subscribers = set()
+
+    async def serve(self):
+        self.stopped = asyncio.Event()
+        if self.handleSignals:
+            self.killer = killer(asyncio.get_running_loop(), lambda: asyncio.create_task(self.shutdown()))
+        for pusher in self.pushers.values():
+            pusher.iqrStatus.monitor.subscribe(lambda iqr_status, pusher=pusher: self.powerChanged(pusher, iqr_status))
+            pusher.start()
+        self.server = await asyncio.start_server(self.handleClient, self.IP, self.port, limit=protocol.MAX_LINE)
+        self.port = self.server.sockets[0].getsockname()[1]
         logging.getLogger("root").info("socket server has established")
+        if self.metricsPort is not None:
+            self.metricsServer = await metrics.startServer(self.IP, self.metricsPort)
+            self.metricsPort = self.metricsServer.sockets[0].getsockname()[1]
+            logging.getLogger("root").info("metrics served on port {:d}".format(self.metricsPort))
+        self.listening.set()
+        await self.stopped.wait()
+        self.server.close()
+        await self.server.wait_closed()
+        if self.metricsPort is not None:
+            self.metricsServer.close()
+        for pusher in self.pushers.values():
+            pusher.stop()
+        for client in list(self.clients):
+            client.close()
+        # let the handlers of the closed connections finish
+        if self.handlers:
+            await asyncio.wait(self.handlers, timeout=1)
+        logging.getLogger("root").info("socket server close")
 
-    def disconnect(self):
-        self.sock.close()
+    async def shutdown(self):
+        # every pusher drops its waiting operations, aborts the running one and brings its rod home
+        await asyncio.gather(*(pusher.shutdown() for pusher in self.pushers.values()))
+        self.stopped.set()
 
-    def accept(self):
-        self.client, addr = self.sock.accept()
-        self.logger.info("build a connection with main server")
+    def pusher(self, args):
+        '''
+        pusher addressed by the arguments of a command
+        '''
+        name = args.get("device", self.default)
+        if name not in self.pushers:
+            raise ValueError("unknown device {!r}".format(name))
+        return self.pushers[name]
 
-    def write(self, cmd):
-        self.client.send(cmd.encode("utf-8"))
+    async def handleClient(self, reader, writer):
+        client = ClientConnection(reader, writer)
+        self.clients.add(client)
+        self.handlers.add(asyncio.current_task())
+        CLIENTS.set(len(self.clients))
+        self.logger.info("build a connection with {}, {:d} client(s) connected".format(client.peer, len(self.clients)))
+        try:
+            while True:
+                try:
+                    msg = await client.read()
+                except protocol.ProtocolError as e:
+                    self.logger.warning("{} from {}".format(e, client.peer))
+                    SOCKET_ERRORS.inc(kind="protocol")
+                    client.send(protocol.reply(None, ok=False, error=str(e)))
+                    if isinstance(e, protocol.OverrunError):
+                        break
+                    continue
+                if msg is None:
+                    break
+                if msg["type"] != protocol.REQUEST:
+                    continue
+                try:
+                    if "id" not in msg or not isinstance(msg.get("cmd"), str) or not isinstance(msg.get("args", {}), dict):
+                        raise ValueError("a request needs an id, a cmd and a dict of args")
+                    await self.dispatch(client, msg["id"], msg["cmd"], msg.get("args", {}))
+                except (KeyError, TypeError, ValueError, AttributeError) as e:
+                    SOCKET_ERRORS.inc(kind="request")
+                    client.send(protocol.reply(msg.get("id"), ok=False, error="invalid request: {}".format(e)))
+        except ConnectionError as e:
+            self.logger.warning("{} from {}".format(e, client.peer))
+            SOCKET_ERRORS.inc(kind="connection")
+        finally:
+            self.clients.discard(client)
+            CLIENTS.set(len(self.clients))
+            self.handlers.discard(asyncio.current_task())
+            self.subscribers.discard(client)
+            client.close()
+            self.logger.info("close a connection with {}".format(client.peer))
 
-    def read(self):
-        data = self.client.recv(4096)
-        return data.decode("utf-8")
+    async def dispatch(self, client, msgid, cmd, args):
+        if cmd == protocol.CMD_INIT or cmd == protocol.CMD_STATUS:
+            # read-only, answered from the cache of the background monitor
+            pusher = self.pusher(args)
+            snapshot = pusher.iqrStatus.monitor.snapshot()
+            if snapshot is None:
+                await pusher.iqrStatus.statusCheck()
+                snapshot = pusher.iqrStatus.monitor.snapshot()
+            client.send(protocol.reply(msgid, device=pusher.name, devices=list(self.pushers), position=pusher.control.steps,
+                interrupted=pusher.control.interrupted, **snapshot))
+        elif cmd == protocol.CMD_SWEEP:
+            # read-only, a fresh probe of every IQR at the same time, which refreshes the caches too
+            timeout = float(args.get("timeout", SWEEP_TIMEOUT))
+            if timeout <= 0:
+                raise ValueError("invalid timeout {!r}".format(timeout))
+            pushers = list(self.pushers.values())
+            results = await probe.sweep([pusher.iqrStatus.monitor for pusher in pushers], timeout, SWEEP_CONCURRENCY)
+            client.send(protocol.reply(msgid, hosts=[dict(result.asDict(), device=pusher.name) for pusher, result in zip(pushers, results)]))
+        elif cmd == protocol.CMD_SUBSCRIBE:
+            self.subscribers.add(client)
+            client.send(protocol.reply(msgid))
+        elif cmd == protocol.CMD_UNSUBSCRIBE:
+            self.subscribers.discard(client)
+            client.send(protocol.reply(msgid))
+        elif cmd == protocol.CMD_ABORT:
+            # never queued, it has to reach the running operation; every pusher stops without a device
+            pushers = [self.pusher(args)] if "device" in args else list(self.pushers.values())
+            aborted = [pusher.name for pusher in pushers if pusher.abort()]
+            logging.getLogger("controller").info("abort requested, {}".format("aborting " + ", ".join(aborted) if aborted else "nothing to abort"))
+            client.send(protocol.reply(msgid, aborted=bool(aborted), devices=aborted))
+        elif cmd == protocol.CMD_JITTER:
+            client.send(protocol.reply(msgid, moves=list(self.pusher(args).jitter)))
+        elif cmd == protocol.CMD_STATS:
+            client.send(protocol.reply(msgid, metrics=metrics.REGISTRY.asDict()))
+        elif cmd == protocol.CMD_PING:
+            client.send(protocol.reply(msgid))
+        elif cmd == protocol.CMD_KILL:
+            # processed after the operations already queued on every pusher
+            self.killing = asyncio.create_task(self.kill(client, msgid))
+        else:
+            await self.pusher(args).dispatch(client, msgid, cmd, args)
 
-class PusherController(ControlServer):
-    def __init__(self):
-        super(PusherController, self).__init__("0.0.0.0", 5052, logging.getLogger("socket"))
-        self.IN1 = 11
-        self.IN2 = 12
-        self.IN3 = 13
-        self.IN4 = 15
-        
-        self.forward_seq = ['1000', '0100', '0010', '0001']
-        self.reverse_seq = ['0001', '0010', '0100', '1000']
+    def powerChanged(self, pusher, iqr_status):
+        pusher.logger("IQR").info("power {}, rtt {} ms".format(iqr_status.state, iqr_status.rtt))
+        for client in self.subscribers:
+            client.send(protocol.event(None, protocol.EVENT_POWER, device=pusher.name, power=iqr_status.state, rtt=iqr_status.rtt))
 
-    def setup(self):
-        GPIO.setwarnings(False)
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setup(self.IN1, GPIO.OUT)
-        GPIO.setup(self.IN2, GPIO.OUT)
-        GPIO.setup(self.IN3, GPIO.OUT)
-        GPIO.setup(self.IN4, GPIO.OUT)
+    async def kill(self, client, msgid):
+        await asyncio.gather(*(pusher.queue.join() for pusher in self.pushers.values()))
+        client.send(protocol.reply(msgid))
+        self.stopped.set()
 
-    def destroy(self):
-        GPIO.cleanup()
 
-    def setStep(self, step):
-        GPIO.output(self.IN1, int(step[0]))
-        GPIO.output(self.IN2, int(step[1]))
-        GPIO.output(self.IN3, int(step[2]))
-        GPIO.output(self.IN4, int(step[3]))
+class Pusher():
+    """
+    one button pusher of the slave: its motor, the IQR behind its button and the queue of its motor operations
+    name:           name of the device in the commands and the calibration file
+    control:        PusherController of the motor
+    iqrStatus:      powerCheck of the IQR
+    profileFile:    file of the calibrated presses, None to keep the calibration in memory only
+    """
+    def __init__(self, name, control, iqrStatus, profileFile=None):
+        self.name = name
+        self.control = control
+        self.iqrStatus = iqrStatus
+        # press of the device, as calibrated if profileFile holds its profile
+        self.profileFile = profileFile
+        self.profile = calibration.DeviceProfile(MOTION_PROFILES["press"], PRESS_STEPS)
+        if profileFile is not None:
+            self.profile = calibration.load(profileFile, name, self.profile)
+        # timing records of the latest motions
+        self.jitter = deque(maxlen=JITTER_HISTORY)
+        # operations by idempotency key or intent, kept until their window expires
+        self.recent = {}
+        # stage of the running operation, published by the progress events
+        self.stage = None
+        self.stageEnd = None
+        self.stageDuration = None
+        # a single thread owns the GPIO pins of the device, so its motions never interleave
+        self.motor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="motor-" + name)
+
+    def logger(self, kind):
+        return logging.getLogger("{}.{}".format(kind, self.name))
+
+    def start(self):
+        '''
+        start the worker of the queue and the background probes of the IQR on the running loop
+        '''
+        self.queue = asyncio.Queue()
+        self.current = None
+        self.tasks = [asyncio.create_task(self.motorWorker()), asyncio.create_task(self.iqrStatus.monitor.run())]
 
     def stop(self):
-        self.setStep('0000')
+        for task in self.tasks:
+            task.cancel()
+        self.motor.shutdown()
 
-    def forward(self, delay, steps):
-        for i in range(0, steps):
-            for step in self.forward_seq:
-                self.setStep(step)
-                time.sleep(delay)
+    async def dispatch(self, client, msgid, cmd, args):
+        # the intent of the operation, the same intent twice in a row is a duplicate, None if it is not
+        if cmd == protocol.CMD_PRESS:
+            checkStep(dict(args, op="press"))
+            operation, params, intent = self.press, (args["mode"],), (cmd, args["mode"])
+        elif cmd == protocol.CMD_ENSURE:
+            if args["power"] not in ("on", "off"):
+                raise ValueError("unknown power state {!r}".format(args["power"]))
+            operation, params, intent = self.ensure, (args["power"],), (cmd, args["power"])
+        elif cmd == protocol.CMD_MOVE:
+            checkStep(dict(args, op="move"))
+            operation, params, intent = self.free, (args["direction"], int(args["steps"])), None
+        elif cmd == protocol.CMD_SEQUENCE:
+            if "macro" in args:
+                name, steps = args["macro"], MACROS[args["macro"]]
+            else:
+                name, steps = "custom", args["steps"]
+            if not isinstance(steps, list) or not steps:
+                raise ValueError("a sequence needs a list of steps")
+            for step in steps:
+                checkStep(step)
+            operation, params, intent = self.sequence, (name, steps), (cmd, args["macro"]) if "macro" in args else None
+        elif cmd == protocol.CMD_CALIBRATE:
+            signal = args.get("signal", "iqr" if self.control.switch is None else "switch")
+            if signal not in CALIBRATION_REPEATS or (signal == "switch" and self.control.switch is None):
+                raise ValueError("no calibration signal {!r}".format(signal))
+            repeats = int(args.get("repeats", CALIBRATION_REPEATS[signal]))
+            if repeats <= 0:
+                raise ValueError("invalid repeats {!r}".format(repeats))
+            operation, params, intent = self.calibrate, (signal, repeats), (cmd, signal)
+        elif cmd == protocol.CMD_HOME:
+            operation, params, intent = self.home, (), (cmd,)
+        else:
+            raise ValueError("unknown command {!r}".format(cmd))
+        self.expire()
+        key = ("key", str(args["key"])) if "key" in args else None
+        # the retry of a request gets its reply, whatever it was
+        if key in self.recent:
+            self.attach(self.recent[key], client, msgid, "key")
+            return
+        if cmd == protocol.CMD_ENSURE and self.settled(args["power"]):
+            # nothing to do and nothing on the way which could change it
+            COALESCED.inc(device=self.name, reason="noop")
+            status = self.iqrStatus.monitor.status
+            attached = Attached(client, msgid)
+            attached.send(protocol.reply(msgid, power=status.state, rtt=status.rtt, noop=True, position=self.control.steps))
+        elif self.reusable(self.recent.get(intent), cmd):
+            self.attach(self.recent[intent], client, msgid, "intent")
+            attached = self.recent[intent]
+        else:
+            attached = Attached(client, msgid)
+            # the operations queued before this one are no duplicates of the requests after it
+            self.recent = {name: other for name, other in self.recent.items() if name[0] == "key"}
+            if intent is not None:
+                self.recent[intent] = attached
+            await self.queue.put((operation, attached, msgid, params))
+            QUEUE_DEPTH.set(self.queue.qsize(), device=self.name)
+        if key is not None:
+            self.recent[key] = attached
 
-    def backward(self, delay, steps):
-        for i in range(0, steps):
-            for step in self.reverse_seq:
-                self.setStep(step)
-                time.sleep(delay)
+    @staticmethod
+    def reusable(attached, cmd):
+        '''
+        whether a request of the same intent can be answered by the operation attached: a waiting or
+        running one, or a finished one which succeeded unless it was an ensure, whose state is checked
+        again; a press which did not change the power state is pressed again
+        '''
+        if attached is None:
+            return False
+        if attached.reply is None:
+            return True
+        return attached.reply["ok"] and attached.reply["data"].get("changed") is not False and cmd != protocol.CMD_ENSURE
 
-class killer():
-    kill_now = False
-    def __init__(self):
-        signal.signal(signal.SIGTERM, self.exit)
-    def exit(self, signum, frame):
-        kill_now = True
+    def expire(self):
+        '''
+        forget the operations finished for longer than the window of their key or intent, the
+        intents are forgotten as well as soon as another operation is queued
+        '''
+        now = asyncio.get_running_loop().time()
+        for name, attached in list(self.recent.items()):
+            window = IDEMPOTENCY_TTL if name[0] == "key" else COALESCE_WINDOW
+            if attached.done is not None and now - attached.done > window:
+                del self.recent[name]
 
-class powerCheck():
-    def __init__(self):
-        self.iqr_ip = "10.10.91.93"
-
-    # ping IP of IQR to get the current status
-    def statusCheck(self):
-        with subprocess.Popen(['ping', '-c1', '-W1', self.iqr_ip], stdout=subprocess.PIPE)as p:
-            data = p.communicate()[0].decode("utf-8")
-            if "100% packet loss" in data:
-                return 0
-            else:
-                return 1
+    def attach(self, attached, client, msgid, reason):
+        self.logger("controller").info("{} request attached to the operation of the same {}".format(client.peer, reason))
+        COALESCED.inc(device=self.name, reason=reason)
+        attached.attach(client, msgid)
 
-    # check if the IQR status change or not
-    def statusChange(self, status):
+    def settled(self, power):
+        '''
+        whether the fresh cached power state is power and no operation could change it
+        '''
+        status = self.iqrStatus.monitor.status
+        return (status is not None and not self.iqrStatus.monitor.stale and status.state == power
+                and self.queue.empty() and self.current is None)
+
+    async def motorWorker(self):
         while True:
-            status_new = self.statusCheck()
-            if status_new == status:
-                status = status_new
-            else:
-                break
-            time.sleep(5)
+            operation, client, msgid, args = await self.queue.get()
+            QUEUE_DEPTH.set(self.queue.qsize(), device=self.name)
+            home = self.control.position
+            self.current = asyncio.create_task(operation(client, msgid, *args))
+            self.setStage(operation.__name__)
+            publisher = asyncio.create_task(self.publish(client, msgid))
+            failure = None
+            try:
+                await asyncio.wait([self.current])
+                if self.current.cancelled():
+                    self.logger("controller").warning("operation aborted")
+                    failure = dict(error="aborted", aborted=True)
+                elif self.current.exception() is not None:
+                    e = self.current.exception()
+                    self.logger("controller").error("operation failed", exc_info=e)
+                    failure = dict(error=str(e))
+                if failure is not None:
+                    await self.retract(home)
+            except Exception as e:
+                self.logger("controller").exception("failed to retract the rod")
+                failure = dict(failure or {}, retracted=False)
+                failure["error"] = "{}, failed to retract the rod: {}".format(failure.get("error", "failed"), e)
+            finally:
+                # the client always gets the failure, or the slot of the intent would wait forever
+                if failure is not None:
+                    client.send(protocol.reply(msgid, ok=False, **failure))
+                publisher.cancel()
+                self.setStage(None)
+                self.current = None
+                self.queue.task_done()
 
+    def setStage(self, stage, duration=None):
+        '''
+        stage of the running operation, with its longest duration in seconds if it is a wait
+        '''
+        self.stage = stage
+        self.stageDuration = duration
+        self.stageEnd = None if duration is None else asyncio.get_running_loop().time() + duration
 
-if __name__=="__main__":
-    # initial the controller
-    control = PusherController()
-    iqrStatus = powerCheck()
-    control.setup()
-
-    while True:
-        killer_peacefull = False
-        # start a new connection
-        control.accept()
+    def progress(self):
+        '''
+        the state of the running operation, as published to its client
+        '''
+        data = {"device": self.name, "stage": self.stage}
+        motion = self.control.progress()
+        if motion is not None:
+            done, phases, position = motion
+            data.update(step=done / self.control.phasesPerStep, steps=phases / self.control.phasesPerStep,
+                    phase=position % self.control.phasesPerStep, position=position / self.control.phasesPerStep)
+        if self.stageEnd is not None:
+            data.update(remaining=round(max(self.stageEnd - asyncio.get_running_loop().time(), 0), 2), duration=self.stageDuration)
+        status = self.iqrStatus.monitor.status
+        if status is not None:
+            data.update(power=status.state, rtt=status.rtt)
+        return data
+
+    async def publish(self, client, msgid):
+        # the motion is never waited for, its progress is estimated from its schedule
         while True:
-            msg = control.read()
-            if msg == "init":
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            client.progress(self.name, protocol.event(msgid, protocol.EVENT_PROGRESS, **self.progress()))
+
+    def abort(self):
+        '''
+        stop the running operation within one coil phase, the worker then brings the rod home
+        '''
+        if self.current is None or self.current.done():
+            return False
+        self.control.cancel.set()
+        self.current.cancel()
+        return True
+
+    async def shutdown(self):
+        # drop the waiting operations, abort the running one and wait for the rod to be home
+        while not self.queue.empty():
+            operation, client, msgid, args = self.queue.get_nowait()
+            client.send(protocol.reply(msgid, ok=False, error="slave shutting down"))
+            self.queue.task_done()
+        QUEUE_DEPTH.set(0, device=self.name)
+        self.abort()
+        await self.queue.join()
+
+    async def runMotor(self, func, *args):
+        with self.control.clock.busy():
+            return await asyncio.get_running_loop().run_in_executor(self.motor, func, *args)
+
+    async def press(self, client, msgid, mode):
+        # monitor the status of IQR
+        self.logger("controller").info("mode {}: {} press".format(1 if mode == "long" else 2, mode))
+        iqr_status = await self.iqrStatus.currentStatus()
+        jitter, hold = await self.pressMotion(client, msgid, mode)
+        self.setStage("wait", self.iqrStatus.detector.timeout)
+        change = await self.iqrStatus.statusChange(iqr_status)
+        self.logChange(change)
+        client.send(protocol.reply(msgid, power=change.status.state, rtt=change.status.rtt, changed=change.changed,
+            transition=round(change.elapsed, 3), hold=round(hold, 3), position=self.control.steps, jitter=jitter))
+
+    async def ensure(self, client, msgid, power):
+        iqr_status = await self.iqrStatus.currentStatus()
+        if iqr_status.state == power:
+            self.logger("controller").info("IQR already {}".format(power))
+            COALESCED.inc(device=self.name, reason="noop")
+            client.send(protocol.reply(msgid, power=iqr_status.state, rtt=iqr_status.rtt, noop=True, position=self.control.steps))
+            return
+        mode = "long" if power == "off" else "short"
+        self.logger("controller").info("ensure {}: {} press".format(power, mode))
+        jitter, hold = await self.pressMotion(client, msgid, mode)
+        timeout = self.iqrStatus.detector.timeout
+        self.setStage("wait", timeout)
+        change = await self.iqrStatus.statusReach(power, timeout)
+        self.logChange(change)
+        result = dict(power=change.status.state, rtt=change.status.rtt, changed=change.changed, transition=round(change.elapsed, 3),
+                hold=round(hold, 3), position=self.control.steps, jitter=jitter)
+        if change.changed:
+            client.send(protocol.reply(msgid, **result))
+        else:
+            client.send(protocol.reply(msgid, ok=False, error="power still {} after {:.0f} s".format(change.status.state, change.elapsed), **result))
+
+    async def free(self, client, msgid, direction, step):
+        self.logger("controller").info("mode 3: free mode")
+        jitter = await self.moveMotion(client, msgid, direction, step)
+        # monitor the status of IQR
+        iqr_status = await self.iqrStatus.currentStatus()
+        client.send(protocol.reply(msgid, power=iqr_status.state, rtt=iqr_status.rtt, position=self.control.steps, jitter=jitter))
+
+    async def home(self, client, msgid):
+        self.logger("controller").info("home from {:g} step(s)".format(self.control.steps))
+        client.send(protocol.event(msgid, protocol.EVENT_PRESS, state="start"))
+        jitter = await self.moveTo(0)
+        client.send(protocol.event(msgid, protocol.EVENT_PRESS, state="stop"))
+        client.send(protocol.reply(msgid, position=self.control.steps, jitter=jitter))
+
+    async def sequence(self, client, msgid, name, steps):
+        self.logger("controller").info("sequence {}: {:d} step(s)".format(name, len(steps)))
+        for index, step in enumerate(steps):
+            client.send(protocol.event(msgid, protocol.EVENT_STEP, index=index, op=step["op"], state="start"))
+            result = {}
+            if step["op"] == "press":
+                result["jitter"], hold = await self.pressMotion(client, msgid, step["mode"])
+                result["hold"] = round(hold, 3)
+            elif step["op"] == "move":
+                result["jitter"] = await self.moveMotion(client, msgid, step["direction"], int(step["steps"]))
+            elif step["op"] == "delay":
+                self.setStage("delay", float(step["seconds"]))
+                await asyncio.sleep(float(step["seconds"]))
+            elif step["op"] == "wait":
+                self.setStage("wait", self.iqrStatus.detector.timeout if step.get("timeout") is None else float(step["timeout"]))
+                change = await self.iqrStatus.statusReach(step["power"], step.get("timeout"))
+                self.logChange(change)
+                result.update(power=change.status.state, transition=round(change.elapsed, 3))
+                if not change.changed:
+                    client.send(protocol.event(msgid, protocol.EVENT_STEP, index=index, op=step["op"], state="failed", **result))
+                    self.logger("controller").warning("sequence {} stopped at step {:d}".format(name, index))
+                    client.send(protocol.reply(msgid, ok=False, error="power still {} after {:.0f} s".format(change.status.state, change.elapsed),
+                        completed=index, power=change.status.state))
+                    return
+            client.send(protocol.event(msgid, protocol.EVENT_STEP, index=index, op=step["op"], state="done", **result))
+        iqr_status = await self.iqrStatus.currentStatus()
+        self.logger("controller").info("sequence {} done".format(name))
+        client.send(protocol.reply(msgid, completed=len(steps), power=iqr_status.state, rtt=iqr_status.rtt))
+
+    async def calibrate(self, client, msgid, signal, repeats):
+        self.logger("controller").info("calibration by {}, {:d} trial(s) per value".format(signal, repeats))
+        press = MOTION_PROFILES["press"]
+        async def trial(name, value, profile, travel):
+            if signal == "switch":
+                ok = await self.switchTrial(profile, travel)
+            else:
+                ok = await self.iqrTrial(client, msgid, profile, travel)
+            self.logger("controller").info("calibration {} {}: {}".format(name, value, "ok" if ok else "failed"))
+            client.send(protocol.event(msgid, protocol.EVENT_TRIAL, param=name, value=value, ok=ok))
+            return ok
+        # the shortest travel at the safe rate, then the fastest rate at that travel
+        travel = await calibration.search(CALIBRATION_TRAVELS,
+                lambda steps: trial("travel", steps, MOTION_PROFILES["free"], steps), repeats)
+        rates = [rate for rate in CALIBRATION_RATES if rate >= press.startRate]
+        rate = await calibration.search(rates,
+                lambda rate: trial("rate", rate, motion.MotionProfile(press.startRate, rate, press.accel), travel), repeats)
+        self.profile = calibration.withMargin(motion.MotionProfile(press.startRate, rate, press.accel), travel,
+                RATE_MARGIN, TRAVEL_MARGIN, signal, PRESS_STEPS)
+        if travel + TRAVEL_MARGIN > PRESS_STEPS:
+            self.logger("controller").warning("travel margin limited to {:d} step(s) by the range of the cam".format(PRESS_STEPS - travel))
+        if self.profileFile is not None:
+            calibration.save(self.profileFile, self.name, self.profile)
+        self.logger("controller").info("calibrated: {!r}".format(self.profile))
+        client.send(protocol.reply(msgid, **self.profile.asDict()))
+
+    async def switchTrial(self, profile, travel):
+        await self.runMove("forward", profile, travel)
+        closed = await self.runMotor(self.control.switchClosed)
+        # back at the safe rate, so that the steps lost by a too fast trial are not lost again
+        await self.runMove("backward", MOTION_PROFILES["free"], travel)
+        if not closed and profile is not MOTION_PROFILES["free"]:
+            await self.rehome(travel)
+        return closed
+
+    async def rehome(self, travel):
+        '''
+        find home again after a motion which lost steps, from the limit switch closing after travel steps
+        '''
+        for step in range(2 * travel):
+            if await self.runMotor(self.control.switchClosed):
                 break
-        iqr_status = iqrStatus.statusCheck()
-        if iqr_status:
-            # power on
-            logging.getLogger("IQR").info("power on")
-            control.write("11")
+            await self.runMove("forward", MOTION_PROFILES["free"], 1)
         else:
-            # power off
-            logging.getLogger("IQR").info("power off")
-            control.write("10")
+            raise RuntimeError("the limit switch does not close, the rod is lost")
+        await self.runMove("backward", MOTION_PROFILES["free"], travel)
+        self.logger("controller").info("home found again {:+g} step(s) from the expected one".format(-self.control.steps))
+        # whole steps, the rotor keeps its phase in the sequence
+        self.control.setPosition(0)
 
-        while True:
-            mode = control.read()
-            if mode == "1":
-                # monitor the status of IQR
-                logging.getLogger("controller").info("mode 1: long press")
-                iqr_status = iqrStatus.statusCheck()
-                # start press
-                logging.getLogger("controller").info("start press!")
-                control.write("1")
-                control.forward(0.005, 20)
-                control.stop()
-                time.sleep(6)
-                control.backward(0.005, 20)
-                control.stop()
-                # stop press
-                logging.getLogger("controller").info("stop press!")
-                control.write("0")
-                time.sleep(5)
-                iqrStatus.statusChange(iqr_status)
-                if iqr_status:
-                    # power off
-                    logging.getLogger("IQR").info("power off")
-                    control.write("10")
-                else:
-                    # power on
-                    logging.getLogger("IQR").info("power on")
-                    control.write("11")
-            elif mode == "2":
-                # monitor the status of IQR
-                logging.getLogger("controller").info("mode 2: short press")
-                iqr_status = iqrStatus.statusCheck()
-                # start press
-                logging.getLogger("controller").info("start press!")
-                control.write("1")
-                control.forward(0.005, 20)
-                control.stop()
-                time.sleep(0.5)
-                control.backward(0.005, 20)
-                control.stop()
-                # stop press
-                logging.getLogger("controller").info("stop press!")
-                control.write("0")
-                time.sleep(5)
-                iqrStatus.statusChange(iqr_status)
-                if iqr_status:
-                    # power off
-                    logging.getLogger("IQR").info("power off")
-                    control.write("10")
-                else:
-                    # power on
-                    logging.getLogger("IQR").info("power on")
-                    control.write("11")
-            elif mode == "3":
-                logging.getLogger("controller").info("mode 3: free mode")
-                inputOperation = control.read()
-                operation, step = map(int, inputOperation.split(","))
-                if operation == 1:
-                    logging.getLogger("controller").info("forward , step: {:d}".format(step))
-                    logging.getLogger("controller").info("start press!")
-                    control.write("1")
-                    control.forward(0.005, step)
-                    control.stop()
-                    logging.getLogger("controller").info("stop press!")
-                    control.write("0")
-                elif operation == 2:
-                    logging.getLogger("controller").info("backward , step: {:d}".format(step))
-                    logging.getLogger("controller").info("start press!")
-                    control.write("1")
-                    control.backward(0.005, step)
-                    control.stop()
-                    logging.getLogger("controller").info("stop press!")
-                    control.write("0")
-                else:
-                    pass
-                time.sleep(5)
-                # monitor the status of IQR
-                iqr_status = iqrStatus.statusCheck()
-                if iqr_status:
-                    # power on
-                    logging.getLogger("IQR").info("power on")
-                    control.write("11")
-                else:
-                    # power off
-                    logging.getLogger("IQR").info("power off")
-                    control.write("10")
-            elif not mode:
-                logging.getLogger("socket").info("close a connection with main server")
+    async def iqrTrial(self, client, msgid, profile, travel):
+        # the press which should toggle the IQR in its current state, back at the safe rate as in switchTrial
+        status = await self.iqrStatus.currentStatus()
+        mode = "long" if status.up else "short"
+        await self.pressMotion(client, msgid, mode, calibration.DeviceProfile(profile, travel), MOTION_PROFILES["free"])
+        self.setStage("wait", CALIBRATION_TIMEOUT["off" if status.up else "on"])
+        change = await self.iqrStatus.statusChange(status, CALIBRATION_TIMEOUT["off" if status.up else "on"])
+        self.logChange(change)
+        if not change.changed and profile is not MOTION_PROFILES["free"]:
+            # the trial may have lost steps, the following ones would start from a shifted home
+            if self.control.switch is None:
+                raise RuntimeError("the press at {:g} phases/s failed, home cannot be confirmed without a limit switch: "
+                        "check the rod in the free mode".format(profile.maxRate))
+            await self.rehome(travel)
+        return change.changed
+
+    async def pressMotion(self, client, msgid, mode, press=None, back=None):
+        '''
+        push the button and release it, return the timing records of the motions and the hold time
+        press:      DeviceProfile of the press, the calibrated one of the pusher by default
+        back:       MotionProfile of the return, the one of the press by default
+        '''
+        press = press or self.profile
+        profile = press.profile
+        # the press is meant to toggle the power state
+        target = not (await self.iqrStatus.currentStatus()).up
+        PRESSES.inc(device=self.name, mode=mode)
+        start = asyncio.get_running_loop().time()
+        # start press
+        self.logger("controller").info("start press!")
+        client.send(protocol.event(msgid, protocol.EVENT_PRESS, state="start"))
+        jitter = [await self.runMove("forward", profile, press.travel)]
+        hold = await self.hold(mode, target)
+        jitter.append(await self.runMove("backward", back or profile, press.travel))
+        PRESS_DURATION.observe(asyncio.get_running_loop().time() - start, device=self.name, mode=mode)
+        # stop press
+        self.logger("controller").info("stop press!")
+        client.send(protocol.event(msgid, protocol.EVENT_PRESS, state="stop"))
+        return jitter, hold
+
+    async def hold(self, mode, target):
+        '''
+        hold the button until the IQR is seen in the power state target (bool), between the shortest
+        and the longest hold of the mode, return the hold time
+        '''
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = start + PRESS_HOLD[mode]
+        self.setStage("hold", PRESS_HOLD[mode])
+        await asyncio.sleep(PRESS_MIN_HOLD[mode])
+        seen = 0
+        while loop.time() < deadline:
+            try:
+                status = await asyncio.wait_for(self.iqrStatus.holdProbe(), deadline - loop.time())
+            except asyncio.TimeoutError:
                 break
-            elif mode == "kill":
-                killer_peacefull = True
+            seen = seen + 1 if status.up == target else 0
+            if seen >= HOLD_CONFIRM:
+                self.logger("controller").info("IQR {} after a hold of {:.2f} s".format(status.state, loop.time() - start))
                 break
-            else:
-                pass
-        if killer_peacefull:
-            logging.getLogger("root").info("socket server close")
-            control.destroy()
-            break
-    control.disconnect()
+            await asyncio.sleep(max(min(HOLD_POLL, deadline - loop.time()), 0))
+        held = loop.time() - start
+        HOLD_TIME.observe(held, device=self.name, mode=mode)
+        return held
+
+    async def moveMotion(self, client, msgid, direction, step):
+        self.logger("controller").info("{} , step: {:d}".format(direction, step))
+        self.logger("controller").info("start press!")
+        client.send(protocol.event(msgid, protocol.EVENT_PRESS, state="start"))
+        jitter = [await self.runMove(direction, MOTION_PROFILES["free"], step)]
+        self.logger("controller").info("stop press!")
+        client.send(protocol.event(msgid, protocol.EVENT_PRESS, state="stop"))
+        return jitter
+
+    def logChange(self, change):
+        if change.changed:
+            self.logger("IQR").info("power {} after {:.2f} s".format(change.status.state, change.elapsed))
+            TRANSITIONS.observe(change.elapsed, device=self.name, power=change.status.state)
+        else:
+            TRANSITION_TIMEOUTS.inc(device=self.name, power="off" if change.status.up else "on")
+            self.logger("IQR").warning("power still {} after {:.0f} s".format(change.status.state, change.elapsed))
+
+    async def runMove(self, direction, profile, steps):
+        '''
+        move the rod and release the coils, return the timing record of the motion
+        '''
+        return await self.runPhases(direction, profile, steps * self.control.phasesPerStep)
+
+    async def runPhases(self, direction, profile, phases):
+        self.setStage(direction)
+        jitter = await self.runMotor(self.control.move, DIRECTIONS[direction], profile, phases)
+        self.setStage(None)
+        await self.runMotor(self.control.stop)
+        steps = jitter.phases / self.control.phasesPerStep
+        self.logger("timing").info("{} {:g} step(s): {}".format(direction, steps, jitter))
+        PHASE_LATENESS.observeMany((late / 1e9 for late in jitter.samples), device=self.name)
+        if jitter.overruns:
+            PHASE_OVERRUNS.inc(jitter.overruns, device=self.name)
+        record = dict(jitter.asDict(), time=time.time(), direction=direction, steps=steps, cancelled=jitter.phases < phases)
+        self.jitter.append(record)
+        return record
+
+    async def retract(self, home):
+        '''
+        bring the rod back to the position home after an aborted operation
+        '''
+        # the motor thread is free once the cancelled motion has stopped
+        await self.runMotor(self.control.stop)
+        self.control.cancel.clear()
+        if self.control.position != home:
+            self.logger("controller").info("retract {:d} phase(s) to the starting point".format(abs(self.control.position - home)))
+        await self.moveTo(home)
+
+    async def moveTo(self, position):
+        '''
+        move the rod to the position in phases ahead of home, return the timing records of the motion
+        '''
+        offset = self.control.position - position
+        if not offset:
+            return []
+        return [await self.runPhases("backward" if offset > 0 else "forward", MOTION_PROFILES["free"], abs(offset))]
+
+
+def checkStep(step):
+    '''
+    validate one step of a sequence before it is queued
+    '''
+    op = step["op"]
+    if op == "press":
+        if step["mode"] not in PRESS_HOLD:
+            raise ValueError("unknown press mode {!r}".format(step["mode"]))
+    elif op == "move":
+        if step["direction"] not in ("forward", "backward") or int(step["steps"]) <= 0:
+            raise ValueError("invalid movement {!r}, {!r}".format(step["direction"], step["steps"]))
+    elif op == "wait":
+        if step["power"] not in ("on", "off"):
+            raise ValueError("unknown power state {!r}".format(step["power"]))
+        if step.get("timeout") is not None and float(step["timeout"]) <= 0:
+            raise ValueError("invalid timeout {!r}".format(step["timeout"]))
+    elif op == "delay":
+        if float(step["seconds"]) < 0:
+            raise ValueError("invalid delay {!r}".format(step["seconds"]))
+    else:
+        raise ValueError("unknown sequence step {!r}".format(op))
+
+
+class PusherController():
+    """
+    journal:    PositionJournal restoring the position of the rod at boot and recording every motion,
+                None to start at home
+    switch:     board pin of the limit switch closed by the cam, None if there is none
+    pins:       board pins of the four coils
+    """
+    def __init__(self, backend=None, sequence="wave", clock=None, journal=None, switch=None, pins=devices.DEFAULT.pins):
+        self.backend = backend if backend is not None else gpiobackend.RPiBackend()
+        self.clock = clock if clock is not None else Clock()
+        self.pins = list(pins)
+        self.switch = switch
+
+        self.sequence = sequence
+        self.phasesPerStep = len(motion.SEQUENCES[sequence])
+        # index in the sequence of the phase held by the rotor
+        self.phase = 0
+        # phases of the rod ahead of home
+        self.position = 0
+        # position the rod was moving to when the slave stopped, None if the position is certain
+        self.interrupted = None
+        self.journal = journal
+        if journal is not None:
+            state = journal.restore(self.phasesPerStep)
+            self.position = state.position
+            self.phase = self.position % self.phasesPerStep
+            self.interrupted = None if state.target is None else state.target / self.phasesPerStep
+            if state.uncertain:
+                logging.getLogger("controller").warning("the slave stopped while moving from {:d} to {:d} phases, the rod is in between".format(
+                    state.position, state.target))
+        # set to stop the running motion before its next phase
+        self.cancel = threading.Event()
+        # (start, end of every phase, direction, position) of the running motion, None between two motions
+        self.motion = None
+        self.scheduler = self.backend.newScheduler(self.setStep, self.clock)
+
+    def setup(self):
+        self.backend.setup(self.pins)
+        if self.switch is not None:
+            self.backend.setupInput(self.switch)
+
+    def switchClosed(self):
+        # the switch pulls its input down
+        return self.backend.input(self.switch) == 0
+
+    def destroy(self):
+        try:
+            self.stop()
+            self.backend.cleanup()
+        finally:
+            if self.journal is not None:
+                self.journal.close()
 
+    @property
+    def steps(self):
+        # position ahead of home in steps
+        return self.position / self.phasesPerStep
 
+    def setStep(self, state):
+        # all the four channels in one call
+        self.backend.output(self.pins, state)
 
+    def stop(self):
+        self.setStep(motion.OFF)
+
+    def setPosition(self, position):
+        '''
+        correct the position in phases after the rod was found elsewhere, by whole steps
+        '''
+        self.position = position
+        if self.journal is not None:
+            self.journal.settled(position)
+
+    def compile(self, direction, phases):
+        return motion.compileMotion(self.sequence, direction, phases, self.phase)
+
+    def run(self, waveform, delays):
+        if self.journal is not None:
+            self.journal.moving(self.position, self.position + waveform.direction * len(waveform))
+        self.motion = (self.clock.monotonic(), list(itertools.accumulate(delays[:len(waveform)])), waveform.direction, self.position)
+        try:
+            jitter = self.scheduler.play(waveform.table, delays, self.cancel)
+        finally:
+            self.motion = None
+        self.phase = waveform.phaseAfter(jitter.phases)
+        self.position += waveform.direction * jitter.phases
+        if self.journal is not None:
+            self.journal.settled(self.position)
+        # a finished motion starts from the position as the operator sees it
+        self.interrupted = None
+        return jitter
+
+    def progress(self):
+        '''
+        (phases played, phases, position in phases) of the running motion as scheduled, None between two motions
+        '''
+        motion = self.motion
+        if motion is None:
+            return None
+        start, ends, direction, position = motion
+        done = min(bisect.bisect_right(ends, self.clock.monotonic() - start) + 1, len(ends))
+        return done, len(ends), position + direction * done
+
+    def move(self, direction, profile, phases):
+        waveform = self.compile(direction, phases)
+        return self.run(waveform, profile.delays(len(waveform)))
+
+    def forward(self, profile, steps):
+        return self.move(motion.FORWARD, profile, steps * self.phasesPerStep)
+
+    def backward(self, profile, steps):
+        return self.move(motion.BACKWARD, profile, steps * self.phasesPerStep)
+
+class killer():
+    kill_now = False
+    def __init__(self, loop, callback):
+        self.callback = callback
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.exit, signum)
+    def exit(self, signum):
+        logging.getLogger("root").info("received {}".format(signal.Signals(signum).name))
+        self.kill_now = True
+        self.callback()
+
+class powerCheck():
+    def __init__(self, iqr_ip="10.10.91.93", tcpPort=445, changeTimeout=180., prober=None, holdTimeout=HOLD_PROBE_TIMEOUT):
+        self.iqr_ip = iqr_ip
+        self.holdTimeout = holdTimeout
+        self.prober = prober if prober is not None else probe.Prober(self.iqr_ip, timeout=1., tcpPort=tcpPort)
+        # every probe goes through the monitor to keep its cache fresh
+        self.monitor = probe.PowerMonitor(self.prober, interval=2., ttl=5.)
+        self.detector = probe.TransitionDetector(self.monitor, timeout=changeTimeout)
+
+    # probe IP of IQR to get the current status
+    async def statusCheck(self):
+        return await self.monitor.probe()
+
+    # probe with a short timeout while the button is held
+    async def holdProbe(self):
+        return await self.monitor.probe(self.holdTimeout)
+
+    # cached status of the IQR if it is still fresh
+    async def currentStatus(self):
+        return await self.monitor.current()
+
+    # wait until the IQR status changes or the timeout expires
+    async def statusChange(self, status, timeout=None):
+        return await self.detector.wait(status.up, timeout)
+
+    # wait until the IQR is in the state power ("on" | "off"), confirmed at once if it is already there
+    async def statusReach(self, power, timeout=None):
+        return await self.detector.wait(power == "off", timeout)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="slave of the remote button pusher")
+    parser.add_argument("--sim", action="store_true", help="simulated motor and IQR, to run without a raspberry pi")
+    parser.add_argument("--threaded-motion", action="store_true", help="play the motions in a thread of the slave instead of a worker process")
+    parser.add_argument("--log-json", action="store_true", help="write the log as JSON lines")
+    parser.add_argument("--metrics-port", type=int, default=9105, help="port of the Prometheus metrics endpoint, 0 to disable it")
+    args = parser.parse_args()
+    logs = logpipe.LogPipeline(LOG_FILE, jsonLines=args.log_json, maxBytes=LOG_MAX_BYTES, interval=LOG_INTERVAL,
+            backupCount=LOG_BACKUPS, queueSize=LOG_QUEUE).start()
+
+    # initial the controllers, one per device of the registry
+    registry = devices.load(DEVICES_FILE)
+    clock = Clock()
+    pushers = []
+    try:
+        for config in registry:
+            if args.sim:
+                backend = gpiobackend.SimBackend(clock)
+                iqrStatus = powerCheck(prober=gpiobackend.SimProber(gpiobackend.SimIQR(backend), host=config.iqr))
+            else:
+                if args.threaded_motion:
+                    backend = gpiobackend.RPiBackend()
+                else:
+                    backend = motionproc.MotionProcess(gpiobackend.RPiBackend, cpu=MOTION_CPU, priority=MOTION_PRIORITY)
+                iqrStatus = powerCheck(config.iqr, config.tcpPort)
+            # the simulated rod starts at home and its cam always has a limit switch
+            control = PusherController(backend, clock=clock, pins=config.pins,
+                    journal=None if args.sim else journal.PositionJournal(POSITION_JOURNAL.format(config.name)),
+                    switch=(config.switch or 16) if args.sim else config.switch)
+            control.setup()
+            pushers.append(Pusher(config.name, control, iqrStatus, profileFile=None if args.sim else PROFILE_FILE))
+        logging.getLogger("root").info("device(s) {}, default {}".format(", ".join(registry.names), registry.default))
+        server = ControlServer("0.0.0.0", 5052, logging.getLogger("socket"), pushers, registry.default,
+                metricsPort=args.metrics_port or None)
+        clock.run(server.serve())
+    finally:
+        # one failed pusher, e.g. with a dead motion process, does not keep the others from their clean-up
+        for pusher in pushers:
+            try:
+                pusher.control.destroy()
+            except Exception:
+                logging.getLogger("root").exception("failed to clean up the pusher {}".format(pusher.name))
+        logs.stop()
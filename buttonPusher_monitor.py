@@ -1,47 +1,305 @@
-#!/usr/bin/env python3
-
-import socket
-
-client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-host = "10.10.91.96"
-port = 5052
-client.connect((host, port))
-
-def loop():
-    print("Welcome to use the remote button pusher[input 'exit' for exit]")
-    while True:
-        print("select the mode(1/2/3) for operation:\n" + "1. long press\n".rjust(4," ") + "2. short press\n".rjust(4, " ") + "3. free".rjust(4, " "))
-        mode = input("mode(1/2/3/exit): ")
-        if mode == "1" or mode == "2":
-            client.send(mode.encode("utf-8"))
-            while True:
-                msg = client.recv(1024).decode("utf-8")
-                print(msg)
-                if msg == "11" or msg == "10":
-                    break
-        elif mode == "3":
-            client.send(mode.encode("utf-8"))
-            inputOperation = input("operation, steps/quit:")
-            if inputOperation == "quit":
-                print("end!")
-            else:
-                client.send(inputOperation.encode("utf-8"))
-                while True:
-                    msg = client.recv(1024).decode("utf-8") 
-                    print(msg)
-                    if msg == "11" or msg == "10":
-                        print(msg)
-                        break
-        elif mode == "exit":
-            break
-        elif mode == "kill":
-            client.send(mode.encode("utf-8"))
-            break
-        else:
-            print("invaild input!")
-        print("\n")
-    client.close()
-
-if __name__=="__main__":
-    loop()
+#!/usr/bin/env python3
+
+'''
+CLI controller of the slave, interactive by default.
+Given commands (as arguments, in a file or on stdin), it runs them in batch mode instead: the
+commands are pipelined on one connection per slave, all the slaves at the same time, every result
+is printed as a JSON line with its timing, followed by the final power state of every slave, and
+the exit code tells whether every IQR ended in the expected state.
+    buttonPusher_monitor.py "press long" "wait off" --expect off
+    buttonPusher_monitor.py --host 10.10.91.96 --host 10.10.91.97 -f powercycle.txt
+    echo status | buttonPusher_monitor.py
+A command is a mode number of the interactive loop, words (press long|short, ensure on|off, move
+forward|backward <steps>, sequence <macro>, wait on|off [timeout], delay <seconds>, calibrate
+[switch|iqr] [repeats], sweep [timeout], home, status, jitter, stats, abort) or a JSON request
+{"cmd": ..., "args": {...}}; empty lines and # comments are skipped. Unlike a press, ensure only
+presses the button if the IQR is not in that state yet, so that a batch run twice never toggles
+the IQR back.
+'''
+
+import sys, json, shlex, asyncio, argparse
+import protocol, probe
+
+host = "10.10.91.96"
+port = 5052
+# pusher of the commands, the default one of the slave if None
+device = None
+client = None
+
+# exit codes of the batch mode
+EXIT_OK          = 0    # every command succeeded and every IQR is in the expected state
+EXIT_STATE       = 1    # an IQR ended in another state
+EXIT_FAILED      = 3    # a command failed
+EXIT_UNREACHABLE = 4    # a slave could not be reached or stopped answering
+# seconds of silence of a slave after which it is pinged, a command queued behind the operations of
+# other controllers gets no event until it runs
+HEARTBEAT = 5.
+# the modes of the interactive loop
+MODES = {
+        "1": (protocol.CMD_PRESS, {"mode": "long"}),
+        "2": (protocol.CMD_PRESS, {"mode": "short"}),
+        "4": (protocol.CMD_SEQUENCE, {"macro": "powercycle"}),
+        "5": (protocol.CMD_HOME, {}),
+        "6": (protocol.CMD_CALIBRATE, {}),
+        "7": (protocol.CMD_SWEEP, {}),
+        "8": (protocol.CMD_ENSURE, {"power": "on"}),
+        "9": (protocol.CMD_ENSURE, {"power": "off"}),
+        }
+
+def execute(cmd, **args):
+    if device is not None:
+        args["device"] = device
+    msgid = client.send(cmd, **args)
+    live = False
+    while True:
+        msg = client.recv()
+        if msg is None:
+            print("connection closed by the slave")
+            return
+        if msg["id"] != msgid:
+            continue
+        if msg["type"] == protocol.EVENT and msg["event"] == protocol.EVENT_PROGRESS:
+            # one live line, rewritten by every progress event
+            print("\r" + protocol.describeProgress(msg["data"]).ljust(72), end="", flush=True)
+            live = True
+            continue
+        if live:
+            print()
+            live = False
+        if msg["type"] == protocol.EVENT:
+            print("{}: {}".format(msg["event"], ", ".join(str(v) for v in msg["data"].values())))
+        elif msg["type"] == protocol.REPLY:
+            if msg["ok"]:
+                if "devices" in msg["data"]:
+                    print("device: {} of {}".format(msg["data"]["device"], ", ".join(msg["data"]["devices"])))
+                if "power" in msg["data"]:
+                    print("power: {}".format(msg["data"]["power"]))
+                if "position" in msg["data"]:
+                    print("position: {:g} step(s) from home".format(msg["data"]["position"]))
+                if msg["data"].get("interrupted") is not None:
+                    print("the slave stopped while moving to {:g} step(s), the rod may be in between!".format(msg["data"]["interrupted"]))
+                if "hosts" in msg["data"]:
+                    print(probe.formatTable(msg["data"]["hosts"]))
+                if "travel" in msg["data"]:
+                    print("calibrated: travel {} step(s), up to {:g} phases/s".format(msg["data"]["travel"], msg["data"]["maxRate"]))
+                if msg["data"].get("noop"):
+                    print("already {}, nothing pressed".format(msg["data"]["power"]))
+                if msg["data"].get("coalesced"):
+                    print("the same operation was already requested, this is its result")
+                if msg["data"].get("changed") is False:
+                    print("the power state did not change!")
+            else:
+                print("error: {}".format(msg.get("error")))
+            return
+
+def loop():
+    print("Welcome to use the remote button pusher[input 'exit' for exit]")
+    execute(protocol.CMD_INIT)
+    while True:
+        print("select the mode(1-9) for operation:\n" + "1. long press\n".rjust(4," ") + "2. short press\n".rjust(4, " ") + "3. free\n".rjust(4, " ") + "4. power cycle\n".rjust(4, " ") + "5. home\n".rjust(4, " ") + "6. calibrate\n".rjust(4, " ") + "7. sweep\n".rjust(4, " ") + "8. ensure on\n".rjust(4, " ") + "9. ensure off".rjust(4, " "))
+        mode = input("mode(1-9/exit): ")
+        if mode == "1":
+            execute(protocol.CMD_PRESS, mode="long")
+        elif mode == "2":
+            execute(protocol.CMD_PRESS, mode="short")
+        elif mode == "3":
+            inputOperation = input("operation, steps/quit:")
+            if inputOperation == "quit":
+                print("end!")
+            else:
+                try:
+                    operation, step = map(int, inputOperation.split(","))
+                except ValueError:
+                    print("invaild input!")
+                    continue
+                direction = {1: "forward", 2: "backward"}.get(operation)
+                if direction is None:
+                    print("invaild input!")
+                else:
+                    execute(protocol.CMD_MOVE, direction=direction, steps=step)
+        elif mode == "4":
+            execute(protocol.CMD_SEQUENCE, macro="powercycle")
+        elif mode == "5":
+            execute(protocol.CMD_HOME)
+        elif mode == "6":
+            execute(protocol.CMD_CALIBRATE)
+        elif mode == "7":
+            execute(protocol.CMD_SWEEP)
+        elif mode in ("8", "9"):
+            execute(protocol.CMD_ENSURE, power="on" if mode == "8" else "off")
+        elif mode == "exit":
+            break
+        elif mode == "kill":
+            client.send(protocol.CMD_KILL)
+            break
+        else:
+            print("invaild input!")
+        print("\n")
+    client.disconnect()
+
+def parseCommand(line):
+    '''
+    return (cmd, args) of one command of a batch
+    '''
+    if line.startswith("{"):
+        request = json.loads(line)
+        return request["cmd"], request.get("args", {})
+    words = shlex.split(line)
+    cmd, rest = words[0], words[1:]
+    if cmd in MODES:
+        return MODES[cmd]
+    if cmd == protocol.CMD_PRESS:
+        args = {"mode": rest.pop(0)}
+    elif cmd == protocol.CMD_ENSURE:
+        args = {"power": rest.pop(0)}
+    elif cmd == protocol.CMD_MOVE:
+        args = {"direction": rest.pop(0), "steps": int(rest.pop(0))}
+    elif cmd == protocol.CMD_SEQUENCE:
+        args = {"macro": rest.pop(0)}
+    elif cmd == protocol.CMD_CALIBRATE:
+        args = {}
+        if rest and not rest[0].isdigit():
+            args["signal"] = rest.pop(0)
+        if rest:
+            args["repeats"] = int(rest.pop(0))
+    elif cmd == protocol.CMD_SWEEP:
+        args = {"timeout": float(rest.pop(0))} if rest else {}
+    elif cmd == "wait":
+        # the steps of a sequence, run by the slave in the queue of the motor
+        step = {"op": "wait", "power": rest.pop(0)}
+        if rest:
+            step["timeout"] = float(rest.pop(0))
+        cmd, args = protocol.CMD_SEQUENCE, {"steps": [step]}
+    elif cmd == "delay":
+        cmd, args = protocol.CMD_SEQUENCE, {"steps": [{"op": "delay", "seconds": float(rest.pop(0))}]}
+    else:
+        args = {}
+    if rest:
+        raise ValueError("too many arguments for {}: {}".format(cmd, " ".join(rest)))
+    return cmd, args
+
+def readCommands(lines):
+    commands = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            commands.append(parseCommand(line))
+    return commands
+
+def output(record):
+    print(json.dumps(record, separators=(',', ':')), flush=True)
+
+async def runBatch(address, commands, device, timeout):
+    '''
+    pipeline the commands on one connection to the slave at address (host, port), print their
+    results, return the final power state, None if unknown, and whether every command succeeded
+    timeout:    seconds without any message of the slave, the replies of the pings included, after which
+                it is taken as unreachable
+    '''
+    loop = asyncio.get_running_loop()
+    name = "{}:{:d}".format(*address)
+    start = loop.time()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*address, limit=protocol.MAX_LINE), timeout)
+    except (OSError, asyncio.TimeoutError) as e:
+        output({"host": name, "ok": False, "error": "unreachable: {}".format(str(e) or "timeout")})
+        return None, None
+    sent, pings, ok = {}, set(), True
+    def send(cmd, args):
+        if device is not None:
+            args = dict(args, device=device)
+        msgid = len(sent) + len(pings) + 1
+        protocol.writeMessage(writer, protocol.request(msgid, cmd, **args))
+        sent[msgid] = (cmd, args, loop.time())
+        return msgid
+    async def receive():
+        # a slave which is quiet, e.g. busy with the operations of other controllers, is pinged
+        heard = loop.time()
+        reading = asyncio.ensure_future(protocol.readMessage(reader))
+        while True:
+            done, pending = await asyncio.wait({reading}, timeout=min(HEARTBEAT, timeout))
+            if done:
+                return reading.result()
+            if loop.time() - heard >= timeout:
+                reading.cancel()
+                raise asyncio.TimeoutError()
+            msgid = len(sent) + len(pings) + 1
+            pings.add(msgid)
+            protocol.writeMessage(writer, protocol.request(msgid, protocol.CMD_PING))
+    async def replyOf(msgids, quiet=False):
+        # the replies come as the operations end
+        replies = {}
+        while not msgids <= replies.keys():
+            msg = await receive()
+            if msg is None:
+                raise ConnectionError("connection closed by the slave")
+            if msg["type"] == protocol.REPLY and msg["id"] in sent:
+                replies[msg["id"]] = msg
+                cmd, args, t = sent[msg["id"]]
+                record = {"host": name, "cmd": cmd, "args": args, "ok": msg["ok"], "seconds": round(loop.time() - t, 3), "data": msg["data"]}
+                if not msg["ok"]:
+                    record["error"] = msg.get("error")
+                if not quiet:
+                    output(record)
+        return replies
+    try:
+        msgids = {send(cmd, args) for cmd, args in commands}
+        await writer.drain()
+        replies = await replyOf(msgids)
+        ok = all(msg["ok"] for msg in replies.values())
+        # once the operations are over, the power state they left
+        final = send(protocol.CMD_STATUS, {})
+        status = (await replyOf({final}, quiet=True))[final]
+    except (OSError, asyncio.TimeoutError) as e:
+        output({"host": name, "ok": False, "error": "unreachable: {}".format(str(e) or "no answer for {:g} s".format(timeout))})
+        return None, None
+    finally:
+        writer.close()
+    power = status["data"].get("power") if status["ok"] else None
+    output({"host": name, "final": True, "ok": ok, "power": power, "seconds": round(loop.time() - start, 3)})
+    return power, ok
+
+async def runBatches(addresses, commands, device, timeout):
+    return await asyncio.gather(*(runBatch(address, commands, device, timeout) for address in addresses))
+
+def parseAddress(text):
+    name, _, number = text.partition(":")
+    return name, int(number) if number else port
+
+def main():
+    global client, device
+    parser = argparse.ArgumentParser(description="CLI controller of the remote button pusher, interactive without commands")
+    parser.add_argument("commands", nargs="*", help="commands of a batch, one per argument")
+    parser.add_argument("-f", "--file", help="file of the commands of a batch, one per line, - for stdin")
+    parser.add_argument("--host", action="append", help="slave as host[:port], repeated for several slaves (default {}:{:d})".format(host, port))
+    parser.add_argument("--device", help="pusher of the commands, the default one of the slave otherwise")
+    parser.add_argument("--expect", choices=("on", "off", "any"), default="on", help="power state every IQR should end in (default on)")
+    parser.add_argument("--timeout", type=float, default=30., help="seconds without any answer from a slave, even to a ping, before giving up")
+    args = parser.parse_args()
+    addresses = [parseAddress(text) for text in args.host or ["{}:{:d}".format(host, port)]]
+    lines = list(args.commands)
+    if args.file == "-" or (args.file is None and not lines and not sys.stdin.isatty()):
+        lines += sys.stdin.readlines()
+    elif args.file is not None:
+        with open(args.file) as f:
+            lines += f.readlines()
+    if not lines:
+        device = args.device
+        client = protocol.Channel(*addresses[0])
+        loop()
+        return EXIT_OK
+    try:
+        commands = readCommands(lines)
+    except (ValueError, IndexError, KeyError) as e:
+        parser.error("invalid command: {}".format(e))
+    results = asyncio.run(runBatches(addresses, commands, args.device, args.timeout))
+    if any(ok is None for power, ok in results):
+        return EXIT_UNREACHABLE
+    if not all(ok for power, ok in results):
+        return EXIT_FAILED
+    if args.expect != "any" and any(power != args.expect for power, ok in results):
+        return EXIT_STATE
+    return EXIT_OK
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+Calibration of the press of one button pusher.
+The calibration sweeps the travel of the rod at a safe rate, then the cruise rate of the motor at
+that travel, and keeps for each of them the value closest to the limit which still actuates the
+button in every trial, with a safety margin. A trial is judged by a limit switch closed by the cam
+or by the change of the power state of the IQR. Both sweeps are binary searches, assuming that a
+longer travel and a slower rate never fail where a shorter travel or a faster rate succeeds.
+The results are kept per device in a JSON file and loaded by the press modes of the slave.
+'''
+
+import json, os, time
+import motion
+
+
+class DeviceProfile():
+    '''
+    press of one device
+    profile:    MotionProfile of the press
+    travel:     steps of the rod to push the button
+    signal:     success signal of the calibration, "switch" or "iqr", None if not calibrated
+    time:       wall clock time of the calibration
+    '''
+    __slots__ = ("profile", "travel", "signal", "time")
+
+    def __init__(self, profile, travel, signal=None, time=None):
+        self.profile = profile
+        self.travel = travel
+        self.signal = signal
+        self.time = time
+
+    def __repr__(self):
+        return "DeviceProfile({!r}, {}, {!r})".format(self.profile, self.travel, self.signal)
+
+    def asDict(self):
+        return {"startRate": self.profile.startRate, "maxRate": self.profile.maxRate, "accel": self.profile.accel,
+                "travel": self.travel, "signal": self.signal, "time": self.time}
+
+    @classmethod
+    def fromDict(cls, d):
+        return cls(motion.MotionProfile(d["startRate"], d["maxRate"], d["accel"]), int(d["travel"]), d.get("signal"), d.get("time"))
+
+
+def load(filename, device, default):
+    '''
+    return the saved profile of the device, or default if it was never calibrated
+    '''
+    try:
+        with open(filename) as f:
+            profiles = json.load(f)
+    except FileNotFoundError:
+        return default
+    return DeviceProfile.fromDict(profiles[device]) if device in profiles else default
+
+
+def save(filename, device, profile):
+    '''
+    replace the profile of the device, keeping the profiles of the other devices
+    '''
+    try:
+        with open(filename) as f:
+            profiles = json.load(f)
+    except FileNotFoundError:
+        profiles = {}
+    profiles[device] = profile.asDict()
+    temporary = filename + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(temporary, filename)
+
+
+async def search(candidates, trial, repeats):
+    '''
+    candidates: values ordered from the safest to the most aggressive, the first one is assumed to work
+    trial:      coroutine function taking a value, returning whether the button was actuated
+    repeats:    consecutive successes needed to accept a value
+    return the most aggressive value accepted
+    '''
+    good, low, high = candidates[0], 1, len(candidates) - 1
+    while low <= high:
+        middle = (low + high) // 2
+        for i in range(repeats):
+            if not await trial(candidates[middle]):
+                high = middle - 1
+                break
+        else:
+            good, low = candidates[middle], middle + 1
+    return good
+
+
+def withMargin(profile, travel, rateMargin, travelMargin, signal, maxTravel):
+    '''
+    the calibrated press, slowed down by the factor rateMargin and lengthened by travelMargin steps,
+    never beyond maxTravel, the range of the cam
+    '''
+    maxRate = max(profile.maxRate * rateMargin, profile.startRate)
+    return DeviceProfile(motion.MotionProfile(profile.startRate, maxRate, profile.accel), min(travel + travelMargin, maxTravel),
+            signal, time.time())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+Clocks driving the timing of the slave.
+Clock is the real time. VirtualClock is a simulated time for the tests and the benchmarks:
+the sleeps of the motion thread advance it at once, and its event loop jumps straight to the
+next timer whenever nothing else is pending, so that a hold of 6 seconds costs no real time.
+Coroutines measure time with the loop (loop.time(), asyncio.sleep()), threads with the clock.
+'''
+
+import asyncio, selectors, threading, time, contextlib, math
+
+
+class Clock():
+    def monotonic_ns(self):
+        return time.monotonic_ns()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def busy(self):
+        '''
+        context of a thread working on behalf of the event loop
+        '''
+        return contextlib.nullcontext()
+
+    def newEventLoop(self):
+        return asyncio.new_event_loop()
+
+    def run(self, coroutine):
+        '''
+        run a coroutine to completion on a new event loop of this clock
+        '''
+        loop = self.newEventLoop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+class VirtualClock(Clock):
+    '''
+    start:          initial time in seconds
+    pollInterval:   real seconds the event loop waits at most while a thread is busy
+    '''
+    def __init__(self, start=0., pollInterval=0.001):
+        self.now = int(start * 1e9)
+        self.pollInterval = pollInterval
+        self.lock = threading.Lock()
+        self.busyCount = 0
+
+    def monotonic_ns(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now / 1e9
+
+    def advance(self, seconds):
+        # rounded up, a timer due in less than a nanosecond must still be reached
+        with self.lock:
+            self.now += max(math.ceil(seconds * 1e9), 0)
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    @contextlib.contextmanager
+    def busy(self):
+        # the loop must not jump ahead while a thread is advancing the time
+        with self.lock:
+            self.busyCount += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.busyCount -= 1
+
+    def newEventLoop(self):
+        return VirtualEventLoop(self)
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    '''
+    selector which advances the virtual clock instead of blocking until the next timer
+    '''
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is not None and not self.clock.busyCount:
+            self.clock.advance(timeout)
+            return []
+        # nothing but real I/O to wait for, or a busy thread which will wake the loop up
+        return super().select(None if timeout is None else min(timeout, self.clock.pollInterval))
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock):
+        super().__init__(VirtualSelector(clock))
+        self.clock = clock
+
+    def time(self):
+        return self.clock.monotonic()
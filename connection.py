@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+Resilient connection of a controller to the slave, which survives a reboot of the raspberry pi.
+A background thread connects within a timeout, so that the caller never blocks, and reads every
+message of the slave: the messages of a request waiting for them go to its queue, the other ones
+to a callback. When the connection has been quiet for a heartbeat interval a ping is sent, and a
+connection silent for longer than the dead timeout is taken as half-open and dropped. The thread
+then reconnects with an exponential backoff, and every new connection starts with an init request
+whose reply restores the power state and the position of the rod on the controller. The requests
+still in flight when the connection is lost get an error reply at once.
+'''
+
+import socket, threading, queue, time, itertools, logging
+import protocol
+
+DISCONNECTED = "disconnected"
+CONNECTING   = "connecting"
+CONNECTED    = "connected"
+
+
+def keepalive(sock, idle=10, interval=5, count=3):
+    '''
+    let the kernel probe an idle connection too, where the system allows it
+    '''
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", interval), ("TCP_KEEPCNT", count)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+class Connection():
+    '''
+    IP, port:       address of the slave
+    connectTimeout: seconds to establish a connection
+    heartbeat:      seconds of silence after which a ping is sent
+    deadTimeout:    seconds of silence after which the connection is taken as half-open
+    backoff:        (first, longest) pause in seconds before reconnecting, doubled after every failure
+    onState:        called with (state, detail) whenever the connection changes its state
+    onMessage:      called with every message no request waits for, the reply of the init included
+    both callbacks are called from the thread of the connection
+    '''
+    def __init__(self, IP, port, connectTimeout=3., heartbeat=2., deadTimeout=6., backoff=(0.5, 30.), onState=None, onMessage=None):
+        self.IP = IP
+        self.port = port
+        self.connectTimeout = connectTimeout
+        self.heartbeat = heartbeat
+        self.deadTimeout = deadTimeout
+        self.backoff = backoff
+        self.onState = onState
+        self.onMessage = onMessage
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.sock = None
+        self.state = DISCONNECTED
+        # requests sent and not replied yet, the queues of the ones waited for, and the pings
+        self.inflight = set()
+        self.waiting = {}
+        self.pings = set()
+        self.sent = self.received = time.monotonic()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="connection", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def disconnect(self):
+        self.stopping.set()
+        with self.lock:
+            sock = self.sock
+        if sock is not None:
+            try:
+                # wakes the reader up
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.thread.join(self.connectTimeout + self.heartbeat)
+
+    @property
+    def connected(self):
+        return self.state == CONNECTED
+
+    def send(self, cmd, **args):
+        '''
+        send a request whose messages go to onMessage, return its id
+        '''
+        return self.post(cmd, args, None)
+
+    def request(self, cmd, **args):
+        '''
+        send a request, return its id and the queue receiving its events and its reply
+        the reply is always delivered, with an error if the connection is lost
+        '''
+        replies = queue.Queue()
+        return self.post(cmd, args, replies), replies
+
+    def post(self, cmd, args, replies):
+        with self.lock:
+            if self.state != CONNECTED:
+                raise ConnectionError("not connected to the slave")
+            msgid = next(self.ids)
+            self.inflight.add(msgid)
+            if replies is not None:
+                self.waiting[msgid] = replies
+            try:
+                self.sock.sendall(protocol.encode(protocol.request(msgid, cmd, **args)))
+            except OSError as e:
+                # the reader finds the broken connection too
+                self.inflight.discard(msgid)
+                self.waiting.pop(msgid, None)
+                raise ConnectionError("failed to send {}: {}".format(cmd, e))
+            self.sent = time.monotonic()
+        return msgid
+
+    def setState(self, state, detail=""):
+        self.state = state
+        logging.getLogger("connection").info("{} {}".format(state, detail))
+        if self.onState is not None:
+            self.onState(state, detail)
+
+    def run(self):
+        pause = self.backoff[0]
+        while not self.stopping.is_set():
+            self.setState(CONNECTING, "to {}:{:d}".format(self.IP, self.port))
+            try:
+                sock = socket.create_connection((self.IP, self.port), self.connectTimeout)
+            except OSError as e:
+                self.setState(DISCONNECTED, "{}, retry in {:.1f} s".format(e, pause))
+                if self.stopping.wait(pause):
+                    break
+                pause = min(pause * 2, self.backoff[1])
+                continue
+            pause = self.backoff[0]
+            keepalive(sock)
+            # the reads wake up in time for the heartbeat
+            sock.settimeout(self.heartbeat / 2)
+            with self.lock:
+                self.sock = sock
+                self.state = CONNECTED
+                self.sent = self.received = time.monotonic()
+            self.setState(CONNECTED, "to {}:{:d}".format(self.IP, self.port))
+            try:
+                # the state of the slave, lost with the former connection
+                self.send(protocol.CMD_INIT)
+                reason = self.read(sock)
+            except (OSError, protocol.ProtocolError) as e:
+                reason = str(e)
+            self.drop(sock, reason)
+        self.setState(DISCONNECTED, "closed")
+
+    def read(self, sock):
+        '''
+        route the messages of the slave until the connection fails, return the reason
+        '''
+        decoder = protocol.Decoder()
+        while not self.stopping.is_set():
+            try:
+                data = sock.recv(4096)
+            except socket.timeout:
+                data = None
+            now = time.monotonic()
+            if data == b"":
+                return "connection closed by the slave"
+            if data:
+                self.received = now
+                for msg in decoder.feed(data):
+                    self.route(msg)
+            elif now - self.received > self.deadTimeout:
+                return "no answer for {:.1f} s, half-open connection".format(now - self.received)
+            if now - max(self.sent, self.received) >= self.heartbeat:
+                self.pings.add(self.send(protocol.CMD_PING))
+        return "closed"
+
+    def route(self, msg):
+        msgid = msg["id"]
+        with self.lock:
+            replies = self.waiting.get(msgid)
+            if msg["type"] == protocol.REPLY:
+                self.inflight.discard(msgid)
+                self.waiting.pop(msgid, None)
+        if msgid in self.pings:
+            if msg["type"] == protocol.REPLY:
+                self.pings.discard(msgid)
+        elif replies is not None:
+            replies.put(msg)
+        elif self.onMessage is not None:
+            self.onMessage(msg)
+
+    def drop(self, sock, reason):
+        with self.lock:
+            self.sock = None
+            self.state = DISCONNECTED
+            lost, self.inflight = sorted(self.inflight - self.pings), set()
+            waiting, self.waiting = self.waiting, {}
+            self.pings.clear()
+        sock.close()
+        self.setState(DISCONNECTED, reason)
+        for msgid in lost:
+            msg = protocol.reply(msgid, ok=False, error="connection lost: {}".format(reason))
+            if msgid in waiting:
+                waiting[msgid].put(msg)
+            elif self.onMessage is not None:
+                self.onMessage(msg)
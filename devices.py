@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+Registry of the button pushers driven by one slave.
+Every device is a stepper motor on four board pins pushing the power button of one IQR, and the
+commands address it by its name. The registry is read from a JSON file:
+    {
+        "default": "iqr1",
+        "devices": {
+            "iqr1": {"pins": [11, 12, 13, 15], "iqr": "10.10.91.93"},
+            "iqr2": {"pins": [29, 31, 33, 35], "iqr": "10.10.91.94", "tcpPort": 445, "switch": 37}
+        }
+    }
+"default" names the device of the commands which do not give one, the first device if it is missing.
+Without the file the slave drives the single pusher it was built for.
+'''
+
+import json
+
+
+class DeviceConfig():
+    '''
+    name:       name of the device in the commands
+    pins:       board pins of the four coils
+    iqr:        address of the IQR behind the button
+    tcpPort:    port probed when ICMP is not permitted
+    switch:     board pin of the limit switch closed by the cam, None if there is none
+    '''
+    __slots__ = ("name", "pins", "iqr", "tcpPort", "switch")
+
+    def __init__(self, name, pins, iqr, tcpPort=445, switch=None):
+        self.name = name
+        self.pins = tuple(pins)
+        self.iqr = iqr
+        self.tcpPort = tcpPort
+        self.switch = switch
+
+    def __repr__(self):
+        return "DeviceConfig({!r}, {}, {!r})".format(self.name, self.pins, self.iqr)
+
+    def asDict(self):
+        return {"pins": list(self.pins), "iqr": self.iqr, "tcpPort": self.tcpPort, "switch": self.switch}
+
+    @classmethod
+    def fromDict(cls, name, d):
+        return cls(name, [int(pin) for pin in d["pins"]], d["iqr"], int(d.get("tcpPort", 445)),
+                None if d.get("switch") is None else int(d["switch"]))
+
+
+# the pusher of the original slave
+DEFAULT = DeviceConfig("default", (11, 12, 13, 15), "10.10.91.93")
+
+
+class Registry():
+    '''
+    devices:    DeviceConfig of every device, in the order of the file
+    default:    name of the device of the commands without a device
+    '''
+    def __init__(self, devices, default=None):
+        if not devices:
+            raise ValueError("no device in the registry")
+        self.devices = {device.name: device for device in devices}
+        self.default = devices[0].name if default is None else default
+        if self.default not in self.devices:
+            raise ValueError("unknown default device {!r}".format(self.default))
+        used = {}
+        for device in devices:
+            if len(device.pins) != 4:
+                raise ValueError("device {!r} needs four coil pins".format(device.name))
+            for pin in device.pins + (() if device.switch is None else (device.switch,)):
+                if pin in used:
+                    raise ValueError("pin {:d} of device {!r} is already used by {!r}".format(pin, device.name, used[pin]))
+                used[pin] = device.name
+
+    def __iter__(self):
+        return iter(self.devices.values())
+
+    def __len__(self):
+        return len(self.devices)
+
+    @property
+    def names(self):
+        return list(self.devices)
+
+
+def load(filename):
+    '''
+    return the Registry of the file, or the single default device if there is no file
+    '''
+    try:
+        with open(filename) as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        return Registry([DEFAULT])
+    return Registry([DeviceConfig.fromDict(name, d) for name, d in config["devices"].items()], config.get("default"))
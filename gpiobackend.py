@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+GPIO backends of the button pusher.
+    - RPiBackend: the pins of the raspberry pi through RPi.GPIO, imported only when used
+    - SimBackend: a simulated motor and cam recording every pin transition, so that the slave
+      can run, be tested and be benchmarked on any linux box
+SimIQR stands in for the IQ recorder behind the button, and SimProber for the probe of its power
+state, both driven by the presses of the simulated cam.
+'''
+
+import asyncio, logging
+import probe, motion
+from clock import Clock
+
+# electrical angle in half steps of each coil state of the 4-wire stepper
+ANGLES = {
+        (1,0,0,0): 0, (1,1,0,0): 1, (0,1,0,0): 2, (0,1,1,0): 3,
+        (0,0,1,0): 4, (0,0,1,1): 5, (0,0,0,1): 6, (1,0,0,1): 7,
+        }
+
+
+class GPIOBackend():
+    '''
+    interface of the backends, pins are numbered on the board
+    '''
+    def setup(self, pins):
+        raise NotImplementedError
+
+    def output(self, pins, state):
+        raise NotImplementedError
+
+    def cleanup(self):
+        raise NotImplementedError
+
+    def setupInput(self, pin):
+        '''
+        input pin with a pull-up, for a switch closing to the ground
+        '''
+        raise NotImplementedError
+
+    def input(self, pin):
+        raise NotImplementedError
+
+    def newScheduler(self, output, clock):
+        '''
+        scheduler playing the motions, by default in the calling thread on the clock of the slave
+        '''
+        return motion.StepScheduler(output, clock=clock.monotonic_ns, sleep=clock.sleep)
+
+
+class RPiBackend(GPIOBackend):
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        # pins of this backend, the other pushers of the slave keep theirs at the clean-up
+        self.pins = []
+
+    def setup(self, pins):
+        self.GPIO.setwarnings(False)
+        self.GPIO.setmode(self.GPIO.BOARD)
+        self.GPIO.setup(pins, self.GPIO.OUT)
+        self.pins.extend(pins)
+
+    def output(self, pins, state):
+        self.GPIO.output(pins, state)
+
+    def cleanup(self):
+        if self.pins:
+            self.GPIO.cleanup(self.pins)
+        self.pins = []
+
+    def setupInput(self, pin):
+        self.GPIO.setup(pin, self.GPIO.IN, pull_up_down=self.GPIO.PUD_UP)
+        self.pins.append(pin)
+
+    def input(self, pin):
+        return self.GPIO.input(pin)
+
+
+class SimBackend(GPIOBackend):
+    '''
+    simulated motor, in half steps of the rotor from its position at start
+    clock:          Clock timestamping the transitions
+    pressAt:        position of the rotor from which the cam pushes the button
+    minPhaseTime:   shortest time between two phases the rotor can follow, faster phases are lost
+    '''
+    def __init__(self, clock=None, pressAt=120, minPhaseTime=0.0015):
+        self.clock = clock or Clock()
+        self.pressAt = pressAt
+        self.minPhaseTime = minPhaseTime
+        self.transitions = []       # (time in ns, state)
+        self.position = 0
+        self.angle = 0
+        self.lostSteps = 0
+        self.pressed = False
+        self.listeners = []         # called with (pressed, time in seconds)
+        self.lastPhase = None
+
+    def setup(self, pins):
+        self.pins = list(pins)
+
+    def cleanup(self):
+        pass
+
+    def setupInput(self, pin):
+        pass
+
+    def input(self, pin):
+        # a limit switch closed by the cam while it pushes the button
+        return 0 if self.pressed else 1
+
+    def output(self, pins, state):
+        now = self.clock.monotonic_ns()
+        state = tuple(state)
+        self.transitions.append((now, state))
+        if state not in ANGLES:
+            # coils released, the rotor holds its position
+            self.lastPhase = None
+            return
+        if self.lastPhase is not None and now - self.lastPhase < self.minPhaseTime * 1e9:
+            self.lastPhase = now
+            self.lostSteps += 1
+            return
+        self.lastPhase = now
+        delta = (ANGLES[state] - self.angle + 4) % 8 - 4
+        if abs(delta) > 2:
+            # the field is opposite to the rotor, it does not know where to turn
+            self.lostSteps += 1
+            return
+        self.angle = ANGLES[state]
+        self.position += delta
+        pressed = self.position >= self.pressAt
+        if pressed != self.pressed:
+            self.pressed = pressed
+            for listener in self.listeners:
+                listener(pressed, now / 1e9)
+
+
+class SimIQR():
+    '''
+    simulated IQ recorder reacting to its power button
+    a short press of an IQR which is off boots it, holding the button of an IQR which is on for
+    longPress seconds shuts it down, even if the button is still held
+    backend:        SimBackend pushing the button
+    on:             initial power state
+    bootTime:       seconds from the release of the button to the answer of the network
+    shutdownTime:   seconds from the end of the long press to the loss of the network
+    '''
+    def __init__(self, backend, on=True, bootTime=20., shutdownTime=1., longPress=4.):
+        self.clock = backend.clock
+        self.bootTime = bootTime
+        self.shutdownTime = shutdownTime
+        self.longPress = longPress
+        # (time in seconds, power state) of every change, the first one at the beginning of time
+        self.changes = [(float("-inf"), on)]
+        self.pressedAt = None
+        backend.listeners.append(self.button)
+
+    def isOn(self, now=None):
+        now = self.clock.monotonic() if now is None else now
+        return [on for t, on in self.changes if t <= now][-1]
+
+    def button(self, pressed, now):
+        if pressed:
+            self.pressedAt = now
+            if self.isOn(now):
+                # taken back if the button is released too early
+                self.changes.append((now + self.longPress + self.shutdownTime, False))
+            return
+        held = now - self.pressedAt
+        if not self.isOn(self.pressedAt):
+            self.changes.append((now + self.bootTime, True))
+        elif held < self.longPress:
+            self.changes.pop()
+        logging.getLogger("sim").info("button held {:.2f} s, IQR {}".format(held, self.changes[-1]))
+
+
+class SimProber():
+    '''
+    stand-in for probe.Prober answering with the state of a SimIQR
+    rtt:        round trip time in milliseconds of an answer
+    timeout:    seconds waited for a host which is off
+    '''
+    def __init__(self, iqr, host="sim", rtt=0.3, timeout=1.):
+        self.iqr = iqr
+        self.host = host
+        self.rtt = rtt
+        self.timeout = timeout
+
+    async def probe(self, timeout=None):
+        if self.iqr.isOn():
+            await asyncio.sleep(self.rtt / 1e3)
+            return probe.ProbeResult(self.host, True, self.rtt, "sim")
+        await asyncio.sleep(self.timeout if timeout is None else timeout)
+        return probe.ProbeResult(self.host, False, None, "sim")
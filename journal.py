@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+Append-only journal of the position of the rod, kept by the slave across restarts.
+Every motion appends two lines: the position before the motion with its target, then the position
+reached. A journal ending with an unfinished motion means that the slave stopped in the middle of
+it, the rod is then somewhere between the two positions. The journal is rewritten with its last
+record only (compaction) at boot and every compactEvery records, through a temporary file which
+replaces the journal atomically. The records are written by the motor thread, but flushed to the
+storage by a thread of the journal, so that a slow SD card never delays a press; a power loss can
+only lose the records written since the last flush, a crash of the slave none.
+    M <position> <target> <phasesPerStep>     moving from position to target
+    P <position> <phasesPerStep>              at rest at position
+The positions are in coil phases ahead of home, phasesPerStep converts them to another sequence.
+'''
+
+import os, logging, threading
+
+
+class PositionState():
+    '''
+    position:   phases ahead of home, the last known position
+    target:     position the rod was moving to, None if the last motion finished
+    '''
+    __slots__ = ("position", "target")
+
+    def __init__(self, position=0, target=None):
+        self.position = position
+        self.target = target
+
+    def __repr__(self):
+        return "PositionState({}, {})".format(self.position, self.target)
+
+    @property
+    def uncertain(self):
+        return self.target is not None
+
+
+class PositionJournal():
+    '''
+    filename:       journal file
+    compactEvery:   records appended before the journal is compacted
+    sync:           flush the records to the storage in the background, so that they survive a power loss
+    '''
+    def __init__(self, filename, compactEvery=500, sync=True):
+        self.filename = filename
+        self.compactEvery = compactEvery
+        self.sync = sync
+        self.file = None
+        self.records = 0
+        self.lock = threading.RLock()
+        # set by every record not flushed to the storage yet
+        self.dirty = threading.Event()
+        self.closing = False
+        if sync:
+            threading.Thread(target=self.syncLoop, name="journal", daemon=True).start()
+
+    def restore(self, phasesPerStep):
+        '''
+        read the journal and return the last PositionState in phases of phasesPerStep, then compact it
+        '''
+        state = PositionState()
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        state = self.parse(line.split(), phasesPerStep)
+                    except (ValueError, IndexError):
+                        # a line torn by a crash, only the last one can be
+                        logging.getLogger("journal").warning("invalid journal record {!r}".format(line))
+        except FileNotFoundError:
+            pass
+        self.phasesPerStep = phasesPerStep
+        self.compact(state)
+        return state
+
+    @staticmethod
+    def parse(fields, phasesPerStep):
+        def convert(position, period):
+            return int(position) if int(period) == phasesPerStep else round(int(position) * phasesPerStep / int(period))
+        if fields[0] == "M":
+            return PositionState(convert(fields[1], fields[3]), convert(fields[2], fields[3]))
+        if fields[0] == "P":
+            return PositionState(convert(fields[1], fields[2]))
+        raise ValueError("unknown record {!r}".format(fields[0]))
+
+    def format(self, state):
+        if state.target is not None:
+            return "M {:d} {:d} {:d}\n".format(state.position, state.target, self.phasesPerStep)
+        return "P {:d} {:d}\n".format(state.position, self.phasesPerStep)
+
+    def moving(self, position, target):
+        self.append(PositionState(position, target))
+
+    def settled(self, position):
+        self.append(PositionState(position))
+
+    def append(self, state):
+        with self.lock:
+            if self.records >= self.compactEvery:
+                self.compact(state)
+                return
+            self.file.write(self.format(state))
+            self.file.flush()
+            self.records += 1
+        self.dirty.set()
+
+    def syncLoop(self):
+        while True:
+            self.dirty.wait()
+            self.dirty.clear()
+            with self.lock:
+                if self.closing:
+                    return
+                # a copy of the descriptor, the motor thread appends while the storage is flushed
+                fd = os.dup(self.file.fileno())
+            try:
+                os.fsync(fd)
+            except OSError as e:
+                logging.getLogger("journal").warning("failed to flush the journal: {}".format(e))
+            finally:
+                os.close(fd)
+
+    def compact(self, state):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            temporary = self.filename + ".tmp"
+            with open(temporary, "w") as f:
+                f.write(self.format(state))
+                f.flush()
+                # the journal is only replaced by a complete file, rarely enough to be waited for
+                if self.sync:
+                    os.fsync(f.fileno())
+            os.replace(temporary, self.filename)
+            self.file = open(self.filename, "a")
+            self.records = 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                if self.sync:
+                    os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+            self.closing = True
+        self.dirty.set()
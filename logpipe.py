@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+Non-blocking logging of the slave.
+The log calls only put the records in a bounded queue, a background thread writes them to the file,
+so that a stall of the SD card never delays the event loop or the motion. When the queue is full
+the records are dropped and counted, and the number of dropped records is logged once there is room
+again. The file is rotated when it grows over a size or gets older than an interval, and the records
+are written either as text lines or as compact JSON lines.
+'''
+
+import logging, logging.handlers, queue, json, time
+import metrics
+
+FORMAT  = '%(asctime)s %(name)-5s %(message)s'
+DATEFMT = '%Y-%m-%d %H:%M:%S'
+
+DROPPED = metrics.Counter("log_records_dropped_total", "log records dropped because the log queue was full")
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''
+    queue handler which never blocks, the records which do not fit in the queue are counted
+    '''
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+        self.reported = 0
+
+    def enqueue(self, record):
+        try:
+            if self.dropped > self.reported:
+                lost = self.dropped - self.reported
+                note = logging.LogRecord("log", logging.WARNING, __file__, 0, "{:d} log record(s) dropped".format(lost), None, None)
+                self.queue.put_nowait(note)
+                self.reported += lost
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            DROPPED.inc()
+
+
+class QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # waits for room in a full queue, the records before it are still written
+        self.queue.put(self._sentinel)
+
+
+class RotatingFileHandler(logging.handlers.RotatingFileHandler):
+    '''
+    rotates the file when it grows over maxBytes or every interval seconds, whichever comes first,
+    and keeps backupCount numbered files (name.1 is the latest)
+    '''
+    def __init__(self, filename, maxBytes=5 * 2**20, interval=7 * 86400, backupCount=4, encoding="utf-8"):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount, encoding=encoding)
+        self.interval = interval
+        self.rolloverAt = time.time() + interval if interval else None
+
+    def shouldRollover(self, record):
+        if self.rolloverAt is not None and time.time() >= self.rolloverAt:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self.rolloverAt = time.time() + self.interval
+
+
+class JSONFormatter(logging.Formatter):
+    '''
+    one JSON object per line: {"t": unix time, "lvl": level, "log": logger, "msg": message, "exc": traceback}
+    '''
+    def format(self, record):
+        entry = {"t": round(record.created, 6), "lvl": record.levelname, "log": record.name, "msg": record.getMessage()}
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(',', ':'))
+
+
+class LogPipeline():
+    '''
+    filename:       log file
+    level:          lowest level logged
+    jsonLines:      write JSON lines instead of text
+    maxBytes:       size of the file which triggers a rotation, 0 for no limit
+    interval:       age in seconds of the file which triggers a rotation, 0 for no limit
+    backupCount:    number of rotated files kept
+    queueSize:      records waiting to be written, the next ones are dropped
+    '''
+    def __init__(self, filename, level=logging.INFO, jsonLines=False, maxBytes=5 * 2**20, interval=7 * 86400, backupCount=4, queueSize=10000):
+        self.file = RotatingFileHandler(filename, maxBytes, interval, backupCount)
+        self.file.setFormatter(JSONFormatter() if jsonLines else logging.Formatter(FORMAT, DATEFMT))
+        self.handler = DroppingQueueHandler(queue.Queue(queueSize))
+        self.listener = QueueListener(self.handler.queue, self.file)
+        self.level = level
+
+    @property
+    def dropped(self):
+        return self.handler.dropped
+
+    def start(self):
+        root = logging.getLogger()
+        root.setLevel(self.level)
+        root.addHandler(self.handler)
+        self.listener.start()
+        return self
+
+    def stop(self):
+        '''
+        write the records still in the queue and close the file
+        '''
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+        self.file.close()
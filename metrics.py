@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+Counters, gauges and histograms of the slave.
+The metrics register themselves in a Registry (REGISTRY by default) when they are created, and the
+registry renders all of them in the Prometheus text format, served over HTTP on a port of its own,
+or as a dictionary for the stats command of the protocol.
+Every metric may have labels, whose values are given as keyword arguments:
+    PRESSES = Counter("pusher_presses_total", "presses of the button", ("mode",))
+    PRESSES.inc(mode="long")
+'''
+
+import asyncio, bisect, math, threading, logging
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        if any(m.name == metric.name for m in self.metrics):
+            raise ValueError("metric {} already registered".format(metric.name))
+        self.metrics.append(metric)
+
+    def render(self):
+        '''
+        all the metrics in the Prometheus text exposition format
+        '''
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help.replace("\\", r"\\").replace("\n", r"\n")))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("{}{} {}".format(name, formatLabels(labels), formatValue(value)))
+        return "\n".join(lines) + "\n"
+
+    def asDict(self):
+        return {metric.name: metric.asDict() for metric in self.metrics}
+
+
+REGISTRY = Registry()
+
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", r"\\").replace('"', r'\"').replace("\n", r"\n") for v in labels.values())
+    return "{" + ",".join('{}="{}"'.format(k, v) for k, v in zip(labels, escaped)) + "}"
+
+def formatValue(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric():
+    '''
+    name:       name of the metric, with the unit as suffix (_seconds, _total...)
+    help:       one line description
+    labelnames: names of the labels, whose values are given to every update
+    '''
+    type = None
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # values by tuple of label values
+        self.values = {}
+        # the metrics may be updated and read from several threads
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            # a metric without labels is exported from the start
+            self.values[()] = self.zero()
+        registry.register(self)
+
+    def zero(self):
+        return 0
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("metric {} has the labels {}, not {}".format(self.name, self.labelnames, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def items(self):
+        with self.lock:
+            return sorted(self.values.items())
+
+    def samples(self):
+        '''
+        yield (name, labels, value) of every time series
+        '''
+        for key, value in self.items():
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+    def asDict(self):
+        return {"type": self.type, "help": self.help,
+                "values": [{"labels": labels, "value": value} for _, labels, value in self.samples()]}
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("a counter only goes up")
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+
+class Histogram(Metric):
+    '''
+    buckets:    increasing upper bounds of the buckets, +Inf is appended
+    '''
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10), registry=REGISTRY):
+        if "le" in labelnames:
+            raise ValueError("le is reserved for the buckets")
+        if list(buckets) != sorted(buckets):
+            raise ValueError("the buckets of {} are not sorted".format(name))
+        self.buckets = tuple(buckets) + (float("inf"),)
+        super().__init__(name, help, labelnames, registry)
+
+    def zero(self):
+        return ([0] * len(self.buckets), 0., 0)
+
+    def observe(self, value, **labels):
+        self.observeMany((value,), **labels)
+
+    def observeMany(self, values, **labels):
+        key = self.key(labels)
+        with self.lock:
+            # (count of each bucket, sum, count), the counts are copied so that a rendering in progress is not changed
+            counts, total, count = self.values.get(key) or self.zero()
+            counts = list(counts)
+            for value in values:
+                counts[bisect.bisect_left(self.buckets, value)] += 1
+                total += value
+                count += 1
+            self.values[key] = (counts, total, count)
+
+    def cumulative(self, counts):
+        running = 0
+        for bound, n in zip(self.buckets, counts):
+            running += n
+            yield bound, running
+
+    def samples(self):
+        for key, (counts, total, count) in self.items():
+            labels = dict(zip(self.labelnames, key))
+            for bound, n in self.cumulative(counts):
+                yield self.name + "_bucket", dict(labels, le=formatValue(bound)), n
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, count
+
+    def asDict(self):
+        values = []
+        for key, (counts, total, count) in self.items():
+            values.append({"labels": dict(zip(self.labelnames, key)),
+                "value": {"count": count, "sum": total, "buckets": {formatValue(b): n for b, n in self.cumulative(counts)}}})
+        return {"type": self.type, "help": self.help, "values": values}
+
+
+async def startServer(IP, port, registry=REGISTRY):
+    '''
+    serve the metrics at http://IP:port/metrics, return the asyncio server
+    '''
+    async def handle(reader, writer):
+        try:
+            requestLine = await reader.readline()
+            # skip the headers
+            while (await reader.readline()).strip():
+                pass
+            parts = requestLine.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body, contentType = "200 OK", registry.render().encode("utf-8"), CONTENT_TYPE
+            else:
+                status, body, contentType = "404 Not Found", b"see /metrics\n", "text/plain"
+            writer.write("HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {:d}\r\nConnection: close\r\n\r\n".format(
+                status, contentType, len(body)).encode("latin-1") + body)
+            await writer.drain()
+        except (ConnectionError, ValueError, asyncio.LimitOverrunError):
+            logging.getLogger("metrics").warning("bad metrics request")
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, IP, port)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+Step waveform engine of the button pusher.
+A motion (sequence, direction, number of steps) is compiled once into a table of pin states,
+which is then played back with one batched output call per coil phase.
+Supported phase sequences of the 4-wire stepper (35BYJ46 with ULN2003):
+    - wave: one coil energized at a time (the original drive, lowest current)
+    - full: two coils energized at a time (more torque)
+    - half: alternates one and two coils (twice the phases per step, smoother)
+One step is one full cycle of the sequence, i.e. the same angle for every sequence.
+The pause after each phase follows a trapezoidal velocity profile: the motion starts below the
+pull-in rate of the motor, accelerates up to a cruise rate and decelerates again before the end.
+The phases are fired on absolute deadlines of a monotonic clock, so that the pauses do not add up
+their errors, and the lateness of every phase is recorded as the jitter of the motion.
+'''
+
+from functools import lru_cache
+import math, time
+
+SEQUENCES = {
+        "wave": ((1,0,0,0), (0,1,0,0), (0,0,1,0), (0,0,0,1)),
+        "full": ((1,1,0,0), (0,1,1,0), (0,0,1,1), (1,0,0,1)),
+        "half": ((1,0,0,0), (1,1,0,0), (0,1,0,0), (0,1,1,0), (0,0,1,0), (0,0,1,1), (0,0,0,1), (1,0,0,1)),
+        }
+
+FORWARD  = 1
+BACKWARD = -1
+
+OFF = (0, 0, 0, 0)
+
+
+class Waveform():
+    '''
+    the compiled table of pin states of a motion
+    table:      pin states to output, one per coil phase
+    direction:  FORWARD or BACKWARD
+    start:      index in the sequence of the phase held before the motion
+    period:     number of phases in the sequence
+    '''
+    __slots__ = ("table", "direction", "start", "period")
+
+    def __init__(self, table, direction, start, period):
+        self.table = table
+        self.direction = direction
+        self.start = start
+        self.period = period
+
+    def __len__(self):
+        return len(self.table)
+
+    def phaseAfter(self, played):
+        '''
+        index in the sequence of the phase held after the first played phases, where the next motion resumes
+        '''
+        return (self.start + self.direction * played) % self.period
+
+
+@lru_cache(maxsize=64)
+def compileMotion(sequence, direction, phases, start):
+    '''
+    sequence:   name of the phase sequence in SEQUENCES
+    direction:  FORWARD or BACKWARD
+    phases:     number of coil phases to play
+    start:      index in the sequence of the phase currently held by the rotor
+    '''
+    seq = SEQUENCES[sequence]
+    n = len(seq)
+    table = tuple(seq[(start + direction * i) % n] for i in range(1, phases + 1))
+    return Waveform(table, direction, start, n)
+
+
+class MotionProfile():
+    '''
+    trapezoidal velocity profile, all the rates in coil phases per second
+    startRate:  rate of the first and the last phase, must be below the pull-in rate of the motor
+    maxRate:    cruise rate
+    accel:      acceleration in phases per second squared
+    '''
+    __slots__ = ("startRate", "maxRate", "accel")
+
+    def __init__(self, startRate, maxRate, accel):
+        if not 0 < startRate <= maxRate or accel <= 0:
+            raise ValueError("invalid motion profile {}, {}, {}".format(startRate, maxRate, accel))
+        self.startRate = startRate
+        self.maxRate = maxRate
+        self.accel = accel
+
+    def __repr__(self):
+        return "MotionProfile({}, {}, {})".format(self.startRate, self.maxRate, self.accel)
+
+    def delays(self, phases):
+        '''
+        return the pause after each of the phases in seconds
+        '''
+        return planProfile(self.startRate, self.maxRate, self.accel, phases)
+
+    def duration(self, phases):
+        return sum(self.delays(phases))
+
+
+@lru_cache(maxsize=64)
+def planProfile(startRate, maxRate, accel, phases):
+    delays = []
+    for i in range(phases):
+        # distance to the closer end of the motion, the ramp down mirrors the ramp up
+        distance = min(i, phases - 1 - i)
+        rate = min(maxRate, math.sqrt(startRate ** 2 + 2 * accel * distance))
+        delays.append(1 / rate)
+    return tuple(delays)
+
+
+class JitterStats():
+    '''
+    lateness of the phases of one motion behind their deadlines, in microseconds
+    overruns:   phases later than a whole pause, after which the schedule restarted from there
+    samples:    lateness of every phase in nanoseconds, sorted
+    '''
+    FIELDS = ("phases", "min", "mean", "p99", "max", "overruns")
+    __slots__ = FIELDS + ("samples",)
+
+    def __init__(self, samples, overruns=0):
+        self.samples = samples = sorted(samples)
+        self.phases = len(samples)
+        self.overruns = overruns
+        if samples:
+            self.min = round(samples[0] / 1e3, 1)
+            self.mean = round(sum(samples) / len(samples) / 1e3, 1)
+            self.p99 = round(samples[math.ceil(0.99 * len(samples)) - 1] / 1e3, 1)
+            self.max = round(samples[-1] / 1e3, 1)
+        else:
+            self.min = self.mean = self.p99 = self.max = 0.
+
+    def __str__(self):
+        return "{:d} phases, jitter min/mean/p99/max {:.0f}/{:.0f}/{:.0f}/{:.0f} us, {:d} overrun(s)".format(
+                self.phases, self.min, self.mean, self.p99, self.max, self.overruns)
+
+    def asDict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+
+class StepScheduler():
+    '''
+    fires the phases of a motion on absolute deadlines
+    output:     function writing one pin state
+    clock:      monotonic clock in nanoseconds
+    sleep:      sleep function taking seconds
+    minGap:     a late phase is caught up, but the pause after it never shrinks below this
+                fraction of the nominal pause, so that the rotor can still follow
+    '''
+    def __init__(self, output, clock=time.monotonic_ns, sleep=time.sleep, minGap=0.5):
+        self.output = output
+        self.clock = clock
+        self.sleep = sleep
+        self.minGap = minGap
+
+    def play(self, table, delays, cancel=None):
+        '''
+        cancel:     event checked before every phase, the motion stops as soon as it is set
+        return the jitter of the phases played, whose number may be short of the table if cancelled
+        '''
+        output, clock, sleep, minGap = self.output, self.clock, self.sleep, self.minGap
+        samples, overruns = [], 0
+        deadline = clock()
+        for state, delay in zip(table, delays):
+            if cancel is not None and cancel.is_set():
+                break
+            now = clock()
+            late = now - deadline
+            output(state)
+            samples.append(late)
+            pause = int(delay * 1e9)
+            if late > pause:
+                # a stall longer than a whole pause is not caught up, restart the schedule
+                overruns += 1
+                deadline = now
+            deadline += pause
+            wait = max(deadline, now + int(pause * minGap)) - clock()
+            if wait > 0:
+                sleep(wait / 1e9)
+        return JitterStats(samples, overruns)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+Motion engine of the slave in a dedicated worker process.
+The worker owns the GPIO backend and plays the motions with its own StepScheduler, so that the
+network, the probes and the logging of the slave never share an interpreter lock with the stepping.
+Where the system allows it, the worker runs with the real-time policy SCHED_FIFO, pinned to one CPU,
+with its memory locked and the garbage collector only run between two motions.
+The slave talks to it over a pipe of compact binary records:
+    request:    header (op, count) + payload
+                PLAY:   count states of one byte (a bit per pin) + count pauses in nanoseconds (uint32)
+                OUTPUT: one state
+                SETUP:  count pin numbers of one byte
+                INPUT:  count is the input pin to read, set up at its first reading
+                QUIT:   nothing
+    reply:      header (status, phases, overruns) + lateness of the phases in nanoseconds (int64),
+                or the error message, or the notes of the set-up; the level of an input is in phases
+An abort reaches the running motion through a shared event checked before every phase.
+'''
+
+import os, gc, struct, signal, ctypes, ctypes.util, logging, threading
+import multiprocessing as mp
+import motion, gpiobackend
+
+OP_PLAY   = 1
+OP_OUTPUT = 2
+OP_SETUP  = 3
+OP_QUIT   = 4
+OP_INPUT  = 5
+
+OK    = 0
+ERROR = 1
+
+HEADER = struct.Struct("<BI")       # op, count
+REPLY  = struct.Struct("<BII")      # status, phases, overruns
+
+MCL_CURRENT = 1
+MCL_FUTURE  = 2
+
+# seconds between two checks of the cancel event of the slave while a motion plays
+CANCEL_POLL = 0.001
+
+
+def encodeState(state):
+    return sum(bit << i for i, bit in enumerate(state))
+
+def decodeState(byte, pins):
+    return tuple((byte >> i) & 1 for i in range(pins))
+
+
+def realtime(cpu, priority):
+    '''
+    give the calling process the real-time settings the system allows, return what was done
+    '''
+    notes = []
+    try:
+        os.sched_setaffinity(0, {cpu})
+        notes.append("pinned to CPU {:d}".format(cpu))
+    except (AttributeError, OSError) as e:
+        notes.append("CPU affinity not set: {}".format(e))
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        notes.append("SCHED_FIFO priority {:d}".format(priority))
+    except (AttributeError, OSError) as e:
+        notes.append("real-time scheduling not permitted: {}".format(e))
+    try:
+        import resource
+        # locking the future pages within a limited quota would make the allocations fail later
+        unlimited = resource.getrlimit(resource.RLIMIT_MEMLOCK)[0] == resource.RLIM_INFINITY
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if libc.mlockall(MCL_CURRENT | (MCL_FUTURE if unlimited else 0)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        notes.append("memory locked")
+    except (ImportError, AttributeError, OSError) as e:
+        notes.append("memory not locked: {}".format(e))
+    gc.disable()
+    return notes
+
+
+def serve(conn, cancel, backendFactory, cpu, priority):
+    '''
+    main loop of the worker process
+    '''
+    # a SIGTERM or a Ctrl-C reaches the whole process group, the slave still needs the worker to
+    # retract the rod before it quits, which it does with OP_QUIT or by closing the pipe
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    notes = realtime(cpu, priority)
+    backend = backendFactory()
+    pins, scheduler, inputs = None, None, set()
+    while True:
+        try:
+            record = conn.recv_bytes()
+        except EOFError:
+            # the slave is gone, release the coils
+            if pins is not None:
+                backend.output(pins, motion.OFF)
+                backend.cleanup()
+            return
+        op, count = HEADER.unpack_from(record)
+        payload = record[HEADER.size:]
+        try:
+            if op == OP_PLAY:
+                table = [decodeState(byte, len(pins)) for byte in payload[:count]]
+                delays = [pause / 1e9 for pause in struct.unpack_from("<{:d}I".format(count), payload, count)]
+                jitter = scheduler.play(table, delays, cancel)
+                reply = REPLY.pack(OK, jitter.phases, jitter.overruns) + struct.pack("<{:d}q".format(jitter.phases), *jitter.samples)
+            elif op == OP_OUTPUT:
+                backend.output(pins, decodeState(payload[0], len(pins)))
+                reply = REPLY.pack(OK, 0, 0)
+            elif op == OP_SETUP:
+                pins = list(payload[:count])
+                backend.setup(pins)
+                scheduler = motion.StepScheduler(lambda state: backend.output(pins, state))
+                reply = REPLY.pack(OK, 0, 0) + "\n".join(notes).encode()
+            elif op == OP_INPUT:
+                if count not in inputs:
+                    backend.setupInput(count)
+                    inputs.add(count)
+                reply = REPLY.pack(OK, backend.input(count), 0)
+            elif op == OP_QUIT:
+                backend.cleanup()
+                conn.send_bytes(REPLY.pack(OK, 0, 0))
+                return
+            else:
+                raise ValueError("unknown operation {:d}".format(op))
+        except Exception as e:
+            reply = REPLY.pack(ERROR, 0, 0) + repr(e).encode()
+        conn.send_bytes(reply)
+        # the garbage of the motion is collected before the next one
+        gc.collect()
+
+
+class MotionProcess(gpiobackend.GPIOBackend):
+    '''
+    GPIO backend living in a worker process, which also plays the whole motions there
+    backendFactory: picklable callable creating the real backend in the worker (e.g. gpiobackend.RPiBackend)
+    cpu:            CPU the worker is pinned to, the last one by default
+    priority:       SCHED_FIFO priority of the worker, from 1 to 99
+    '''
+    def __init__(self, backendFactory, cpu=None, priority=50):
+        self.cpu = os.cpu_count() - 1 if cpu is None else cpu
+        self.priority = priority
+        # a new interpreter, not a copy of the threads and locks of the slave
+        context = mp.get_context("spawn")
+        self.conn, child = context.Pipe()
+        self.abort = context.Event()
+        self.process = context.Process(target=serve, args=(child, self.abort, backendFactory, self.cpu, self.priority),
+                name="motion", daemon=True)
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock()
+
+    def request(self, op, payload=b"", count=0, cancel=None):
+        '''
+        send one record and wait for its reply, return (phases, overruns, data)
+        '''
+        with self.lock:
+            if not self.process.is_alive():
+                raise RuntimeError("the motion process died with the exit code {}".format(self.process.exitcode))
+            try:
+                self.conn.send_bytes(HEADER.pack(op, count) + payload)
+                while not self.conn.poll(CANCEL_POLL):
+                    if cancel is not None and cancel.is_set():
+                        self.abort.set()
+                    if not self.process.is_alive():
+                        raise RuntimeError("the motion process died with the exit code {}".format(self.process.exitcode))
+                reply = self.conn.recv_bytes()
+            except (OSError, EOFError) as e:
+                raise RuntimeError("the motion process is gone: {!r}".format(e))
+        status, phases, overruns = REPLY.unpack_from(reply)
+        if status != OK:
+            raise RuntimeError("motion process: {}".format(reply[REPLY.size:].decode()))
+        return phases, overruns, reply[REPLY.size:]
+
+    def setup(self, pins):
+        _, _, notes = self.request(OP_SETUP, bytes(pins), len(pins))
+        for note in notes.decode().splitlines():
+            logging.getLogger("motion").info(note)
+
+    def output(self, pins, state):
+        self.request(OP_OUTPUT, bytes([encodeState(state)]), 1)
+
+    def setupInput(self, pin):
+        # set up by the worker at the first reading
+        pass
+
+    def input(self, pin):
+        return self.request(OP_INPUT, count=pin)[0]
+
+    def cleanup(self):
+        try:
+            if self.process.is_alive():
+                self.request(OP_QUIT)
+                self.process.join(5)
+        finally:
+            self.conn.close()
+
+    def newScheduler(self, output, clock):
+        # the motions are played by the worker on the real clock
+        return self
+
+    def play(self, table, delays, cancel=None):
+        '''
+        same as motion.StepScheduler.play, in the worker process
+        '''
+        if cancel is not None and cancel.is_set():
+            return motion.JitterStats([])
+        count = len(table)
+        payload = bytes(encodeState(state) for state in table) + struct.pack("<{:d}I".format(count), *(int(d * 1e9) for d in delays[:count]))
+        try:
+            phases, overruns, data = self.request(OP_PLAY, payload, count, cancel)
+        finally:
+            self.abort.clear()
+        return motion.JitterStats(struct.unpack("<{:d}q".format(phases), data), overruns)
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+In-process prober of the power state of a host, running on the asyncio event loop.
+It sends an ICMP echo request over an unprivileged ICMP datagram socket (on linux the group of the
+user must be allowed in net.ipv4.ping_group_range). Where such sockets are not permitted, it falls
+back to a TCP connection to a configurable port: an accepted or a refused connection both mean
+that the host is up, only a timeout or an unreachable host means that it is down.
+A TransitionDetector waits for the host to change its state: it polls fast right after the action
+that should toggle it and backs off exponentially, accepts the new state only after a number of
+consecutive agreeing probes, and gives up with a definite "no change" after a timeout.
+A PowerMonitor probes the host in the background and keeps the latest result as a cached status,
+which can be read at once and is flagged stale when older than its time to live.
+A sweep probes many hosts at the same time, at most a number of them at once and each within its
+own timeout, so that the status of a whole fleet takes about one timeout instead of one per host.
+    python3 probe.py 10.10.91.93 10.10.91.94 [--timeout 1] [--concurrency 32] [--json]
+'''
+
+import asyncio, socket, struct, time, os, itertools, logging, argparse, json
+import metrics
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY   = 0
+
+PROBES    = metrics.Counter("iqr_probes_total", "probes of the IQR by result: up, down (no answer) or error", ("host", "result"))
+PROBE_RTT = metrics.Histogram("iqr_probe_rtt_seconds", "round trip time of the answered probes", ("host",),
+        buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+
+
+class ProbeResult():
+    '''
+    host:       probed address
+    up:         whether the host answered
+    rtt:        round trip time in milliseconds, None if the host did not answer
+    method:     "icmp" or "tcp", or "timeout" | "error" for a sweep which got no result
+    time:       wall clock time of the probe
+    '''
+    __slots__ = ("host", "up", "rtt", "method", "time")
+
+    def __init__(self, host, up, rtt, method):
+        self.host = host
+        self.up = up
+        self.rtt = rtt
+        self.method = method
+        self.time = time.time()
+
+    def __repr__(self):
+        return "ProbeResult({!r}, {}, {}, {!r})".format(self.host, self.up, self.rtt, self.method)
+
+    @property
+    def state(self):
+        return "on" if self.up else "off"
+
+    def asDict(self):
+        return {"host": self.host, "power": self.state, "rtt": self.rtt, "method": self.method, "time": self.time}
+
+
+def checksum(data):
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack("!{:d}H".format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+class Prober():
+    '''
+    host:       address to probe
+    timeout:    seconds to wait for an answer
+    tcpPort:    port of the TCP fallback probe
+    method:     "icmp", "tcp", or None to use ICMP whenever the system allows it
+    '''
+    def __init__(self, host, timeout=1., tcpPort=445, method=None):
+        self.host = host
+        self.timeout = timeout
+        self.tcpPort = tcpPort
+        self.method = method
+        self.sequence = itertools.count(1)
+
+    async def probe(self, timeout=None):
+        '''
+        timeout:    seconds to wait for an answer, instead of the default one
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        if self.method != "tcp":
+            try:
+                return await self.probeICMP(timeout)
+            except PermissionError:
+                if self.method == "icmp":
+                    raise
+                logging.getLogger("probe").warning("ICMP datagram sockets not permitted, probe TCP port {:d} instead".format(self.tcpPort))
+                self.method = "tcp"
+        return await self.probeTCP(timeout)
+
+    async def probeICMP(self, timeout):
+        loop = asyncio.get_running_loop()
+        seq = next(self.sequence) & 0xFFFF
+        # the kernel replaces the identifier by the port of the socket
+        header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, 0, seq)
+        payload = struct.pack("!d", time.monotonic()) + os.urandom(8)
+        packet = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, checksum(header + payload), 0, seq) + payload
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP) as sock:
+            sock.setblocking(False)
+            start = time.monotonic()
+            try:
+                # loop.sock_connect() would resolve the address for a socket type it does not support
+                info = await loop.getaddrinfo(self.host, None, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+                sock.connect((info[0][4][0], 0))
+                await loop.sock_sendall(sock, packet)
+                deadline = start + timeout
+                while True:
+                    data = await asyncio.wait_for(loop.sock_recv(sock, 1024), max(deadline - time.monotonic(), 0))
+                    icmpType, _, _, _, replySeq = struct.unpack("!BBHHH", data[:8])
+                    if icmpType == ICMP_ECHO_REPLY and replySeq == seq and data[8:] == payload:
+                        return ProbeResult(self.host, True, round((time.monotonic() - start) * 1e3, 3), "icmp")
+            except (asyncio.TimeoutError, OSError):
+                # no answer in time, unreachable host or network
+                pass
+        return ProbeResult(self.host, False, None, "icmp")
+
+    async def probeTCP(self, timeout):
+        start = time.monotonic()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.tcpPort), timeout)
+            writer.close()
+        except ConnectionRefusedError:
+            # refused by a running host
+            pass
+        except (asyncio.TimeoutError, OSError):
+            return ProbeResult(self.host, False, None, "tcp")
+        return ProbeResult(self.host, True, round((time.monotonic() - start) * 1e3, 3), "tcp")
+
+
+class TransitionResult():
+    '''
+    changed:    whether the state changed within the timeout
+    status:     the last probe result
+    elapsed:    seconds from the start of the wait to the first probe showing the new state,
+                or to the timeout if the state did not change
+    probes:     number of probes sent
+    '''
+    __slots__ = ("changed", "status", "elapsed", "probes")
+
+    def __init__(self, changed, status, elapsed, probes):
+        self.changed = changed
+        self.status = status
+        self.elapsed = elapsed
+        self.probes = probes
+
+    def __repr__(self):
+        return "TransitionResult({}, {!r}, {:.2f}, {:d})".format(self.changed, self.status, self.elapsed, self.probes)
+
+
+class TransitionDetector():
+    '''
+    prober:         Prober of the host
+    timeout:        seconds after which the wait ends with no change
+    firstInterval:  pause between the first probes, also used while confirming a new state
+    maxInterval:    longest pause between two probes
+    backoff:        factor applied to the pause after every probe showing the old state
+    confirm:        number of consecutive probes which must show the new state
+    '''
+    def __init__(self, prober, timeout=180., firstInterval=0.25, maxInterval=5., backoff=1.5, confirm=3):
+        self.prober = prober
+        self.timeout = timeout
+        self.firstInterval = firstInterval
+        self.maxInterval = maxInterval
+        self.backoff = backoff
+        self.confirm = confirm
+
+    async def wait(self, up, timeout=None):
+        '''
+        wait until the host leaves the state up (bool), timeout overrides the default one
+        '''
+        timeout = self.timeout if timeout is None else float(timeout)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        interval = self.firstInterval
+        agreeing, firstSeen, probes = 0, None, 0
+        while True:
+            status = await self.prober.probe()
+            probes += 1
+            now = loop.time()
+            if status.up != up:
+                if not agreeing:
+                    firstSeen = now
+                agreeing += 1
+                if agreeing >= self.confirm:
+                    return TransitionResult(True, status, firstSeen - start, probes)
+                pause = self.firstInterval
+            else:
+                # flapping, the new state must be confirmed again
+                agreeing, firstSeen = 0, None
+                pause = interval
+                interval = min(interval * self.backoff, self.maxInterval)
+            if now + pause - start > timeout:
+                return TransitionResult(False, status, now - start, probes)
+            await asyncio.sleep(pause)
+
+
+class PowerMonitor():
+    '''
+    prober:     Prober of the host
+    interval:   seconds between two background probes
+    ttl:        age in seconds after which the cached status is stale
+    every probe sent through the monitor refreshes the cache and the metrics, and the listeners are called
+    with the new result whenever the state changes
+    '''
+    def __init__(self, prober, interval=2., ttl=5.):
+        self.prober = prober
+        self.interval = interval
+        self.ttl = ttl
+        self.status = None
+        self.updated = None
+        self.listeners = []
+
+    @property
+    def host(self):
+        return self.prober.host
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    async def probe(self, timeout=None):
+        try:
+            status = await self.prober.probe(timeout)
+        except OSError:
+            PROBES.inc(host=self.prober.host, result="error")
+            raise
+        PROBES.inc(host=self.prober.host, result="up" if status.up else "down")
+        if status.rtt is not None:
+            PROBE_RTT.observe(status.rtt / 1e3, host=self.prober.host)
+        previous, self.status, self.updated = self.status, status, asyncio.get_running_loop().time()
+        if previous is not None and previous.up != status.up:
+            for listener in list(self.listeners):
+                listener(status)
+        return status
+
+    async def run(self):
+        while True:
+            try:
+                await self.probe()
+            except OSError:
+                logging.getLogger("probe").exception("background probe failed")
+            await asyncio.sleep(self.interval)
+
+    @property
+    def age(self):
+        return None if self.updated is None else asyncio.get_running_loop().time() - self.updated
+
+    @property
+    def stale(self):
+        return self.updated is None or self.age > self.ttl
+
+    async def current(self):
+        '''
+        return the cached status, or probe at once if it is stale
+        '''
+        if self.stale:
+            return await self.probe()
+        return self.status
+
+    def snapshot(self):
+        '''
+        cached status as a dictionary, None before the first probe
+        '''
+        if self.status is None:
+            return None
+        return {"power": self.status.state, "rtt": self.status.rtt, "age": round(self.age, 3), "stale": self.stale}
+
+
+async def sweep(probers, timeout=1., concurrency=32):
+    '''
+    probe all the hosts at the same time, at most concurrency of them at once
+    probers:        Prober or PowerMonitor of every host
+    timeout:        seconds given to each host, name resolution included
+    return the ProbeResult of every host in the order of probers, a host without result is down
+    '''
+    slots = asyncio.Semaphore(concurrency)
+    async def one(prober):
+        async with slots:
+            try:
+                return await asyncio.wait_for(prober.probe(timeout), timeout)
+            except asyncio.TimeoutError:
+                return ProbeResult(prober.host, False, None, "timeout")
+            except OSError as e:
+                logging.getLogger("probe").warning("probe of {} failed: {}".format(prober.host, e))
+                return ProbeResult(prober.host, False, None, "error")
+    return await asyncio.gather(*(one(prober) for prober in probers))
+
+
+def formatTable(rows):
+    '''
+    status table of a sweep, rows are ProbeResult.asDict() with an optional "device"
+    '''
+    devices = any("device" in row for row in rows)
+    lines = [("{:<12s} ".format("device") if devices else "") + "{:<20s} {:<5s} {:>9s}  {}".format("host", "power", "rtt (ms)", "method")]
+    for row in rows:
+        rtt = "-" if row["rtt"] is None else "{:.3f}".format(row["rtt"])
+        lines.append(("{:<12s} ".format(row.get("device", "")) if devices else "") +
+                "{:<20s} {:<5s} {:>9s}  {}".format(row["host"], row["power"], rtt, row["method"]))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="probe the power state of many hosts at the same time")
+    parser.add_argument("hosts", nargs="+", help="addresses of the hosts")
+    parser.add_argument("-t", "--timeout", type=float, default=1., help="seconds to wait for each host")
+    parser.add_argument("-c", "--concurrency", type=int, default=32, help="hosts probed at once")
+    parser.add_argument("--tcp-port", type=int, default=445, help="port probed where ICMP is not permitted")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    probers = [Prober(host, args.timeout, args.tcp_port) for host in args.hosts]
+    start = time.monotonic()
+    results = asyncio.run(sweep(probers, args.timeout, args.concurrency))
+    if args.json:
+        print(json.dumps([result.asDict() for result in results]))
+    else:
+        print(formatTable([result.asDict() for result in results]))
+        print("{:d} host(s) up of {:d} in {:.2f} s".format(sum(result.up for result in results), len(results), time.monotonic() - start))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+The wire protocol shared by the slave on the raspberry pi and the controllers (GUI, CLI).
+Every message is one JSON object terminated by a newline, so that messages can never be merged
+or split by the TCP stream, and several requests can be pipelined on one connection.
+    request:    {"type": "request", "id": 3, "cmd": "press", "args": {"mode": "long"}}
+    event:      {"type": "event", "id": 3, "event": "press", "data": {"state": "start"}}
+    reply:      {"type": "reply", "id": 3, "ok": true, "data": {"power": "on"}}
+Events and the final reply of a request carry the id of that request.
+Events pushed by the slave on its own carry the id None.
+A slave may drive several pushers: the commands of a motor, the power status and the jitter take
+the name of one as the argument device, without it they address the default pusher of the slave.
+The commands of a motor may carry an idempotency key as the argument key: a request repeating the
+key of an earlier one is not run again but gets the reply of the earlier one, marked coalesced.
+'''
+
+import json, socket, itertools, asyncio
+
+ENCODING = "utf-8"
+MAX_LINE = 64 * 1024     # longest accepted message in bytes
+
+# message types
+REQUEST = "request"
+EVENT   = "event"
+REPLY   = "reply"
+
+# commands
+CMD_INIT        = "init"        # handshake, replied with the power status, the position of the rod and the devices
+CMD_STATUS      = "status"      # read-only power status, answered from the cache of the slave
+CMD_SWEEP       = "sweep"       # power status of every IQR of the slave, probed at the same time; args: timeout (optional)
+CMD_SUBSCRIBE   = "subscribe"   # receive the power events pushed by the slave
+CMD_UNSUBSCRIBE = "unsubscribe"
+CMD_PRESS       = "press"       # args: mode = "long" | "short"
+CMD_ENSURE      = "ensure"      # args: power = "on" | "off", pressed only if the IQR is not in that state yet
+CMD_MOVE        = "move"        # args: direction = "forward" | "backward", steps = int
+CMD_SEQUENCE    = "sequence"    # args: macro = name | steps = [{"op": ...}, ...]
+CMD_CALIBRATE   = "calibrate"   # args: signal = "switch" | "iqr", repeats = int (both optional)
+CMD_HOME        = "home"        # bring the rod back to its home position
+CMD_ABORT       = "abort"       # stop the running operation and bring the rod home, of every device without one
+CMD_JITTER      = "jitter"      # step timing of the latest motions
+CMD_STATS       = "stats"       # counters, gauges and histograms of the slave
+CMD_PING        = "ping"        # heartbeat of the controllers, replied at once
+CMD_KILL        = "kill"        # shut the slave down
+
+# events
+EVENT_PRESS     = "press"       # data: state = "start" | "stop"
+EVENT_POWER     = "power"       # data: device, power = "on" | "off", rtt = ms
+EVENT_STEP      = "step"        # data: index, op, state = "start" | "done" | "failed"
+EVENT_TRIAL     = "trial"       # data: param = "travel" | "rate", value, ok
+EVENT_PROGRESS  = "progress"    # data: device, stage, step, steps, phase, position, remaining, duration, power, rtt (the known ones)
+                                # latest state of the running operation, sent every fraction of a second
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class OverrunError(ProtocolError):
+    '''
+    a message longer than MAX_LINE, the rest of the stream cannot be read any more
+    '''
+    pass
+
+
+def request(msgid, cmd, **args):
+    return {"type": REQUEST, "id": msgid, "cmd": cmd, "args": args}
+
+def event(msgid, name, **data):
+    return {"type": EVENT, "id": msgid, "event": name, "data": data}
+
+def reply(msgid, ok=True, error=None, **data):
+    msg = {"type": REPLY, "id": msgid, "ok": ok, "data": data}
+    if error is not None:
+        msg["error"] = error
+    return msg
+
+def encode(msg):
+    return json.dumps(msg, separators=(',', ':')).encode(ENCODING) + b"\n"
+
+def decode(line):
+    try:
+        msg = json.loads(line.decode(ENCODING))
+    except ValueError as e:
+        raise ProtocolError("malformed message: {}".format(e))
+    if not isinstance(msg, dict) or msg.get("type") not in (REQUEST, EVENT, REPLY):
+        raise ProtocolError("unknown message: {!r}".format(msg))
+    return msg
+
+
+class Decoder():
+    '''
+    incremental decoder, turns the received byte chunks into whole messages
+    '''
+    def __init__(self):
+        self.buffer = b""
+
+    def feed(self, data):
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b"\n")
+        if len(self.buffer) > MAX_LINE:
+            raise OverrunError("message longer than {:d} bytes".format(MAX_LINE))
+        return [decode(line) for line in lines if line.strip()]
+
+
+class Channel():
+    '''
+    blocking client side of the protocol
+    '''
+    def __init__(self, IP, port, timeout=None):
+        self.IP = IP
+        self.port = port
+        self.timeout = timeout
+        self.ids = itertools.count(1)
+        self.decoder = Decoder()
+        self.pending = []
+        self.connect()
+
+    def connect(self):
+        self.sock = socket.create_connection((self.IP, self.port), self.timeout)
+
+    def disconnect(self):
+        self.sock.close()
+
+    def send(self, cmd, **args):
+        '''
+        send a request and return its id
+        '''
+        msgid = next(self.ids)
+        self.sock.sendall(encode(request(msgid, cmd, **args)))
+        return msgid
+
+    def recv(self):
+        '''
+        return the next message, or None once the slave closed the connection
+        '''
+        while not self.pending:
+            data = self.sock.recv(4096)
+            if not data:
+                return None
+            self.pending.extend(self.decoder.feed(data))
+        return self.pending.pop(0)
+
+
+async def readMessage(reader):
+    '''
+    read one message from an asyncio stream, None at the end of the stream
+    '''
+    try:
+        line = await reader.readuntil(b"\n")
+    except asyncio.IncompleteReadError:
+        return None
+    except asyncio.LimitOverrunError:
+        # the stream keeps the oversized data, every later read would fail at once
+        raise OverrunError("message longer than {:d} bytes".format(MAX_LINE))
+    return decode(line)
+
+def writeMessage(writer, msg):
+    writer.write(encode(msg))
+
+
+def describeProgress(data):
+    '''
+    one line of text of the data of a progress event
+    '''
+    parts = [data["stage"] or "running"]
+    if "steps" in data:
+        parts.append("{:g}/{:g} steps".format(data["step"], data["steps"]))
+    if "remaining" in data:
+        parts.append("{:.1f} s left".format(data["remaining"]))
+    if "power" in data:
+        parts.append("IQR {}".format(data["power"]) + ("" if data["rtt"] is None else " ({:g} ms)".format(data["rtt"])))
+    return ", ".join(parts)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+Coalescing of the duplicate requests of a pusher, on the virtual clock and the simulated motor.
+'''
+
+import os, sys, asyncio, logging
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import buttonPusher_Slave as slave, gpiobackend, protocol
+from clock import VirtualClock
+
+
+def run(on, requests, longPress=4.):
+    '''
+    send the requests (cmd, args) one after the other to a slave whose IQR is on or off,
+    return their replies and whether the IQR is on at the end
+    longPress:  seconds the button of the IQR has to be held to shut it down
+    '''
+    clock = VirtualClock()
+    backend = gpiobackend.SimBackend(clock)
+    iqr = gpiobackend.SimIQR(backend, on=on, longPress=longPress)
+    control = slave.PusherController(backend, clock=clock)
+    control.setup()
+    server = slave.ControlServer("127.0.0.1", 0, logging.getLogger("socket"),
+            [slave.Pusher("default", control, slave.powerCheck(prober=gpiobackend.SimProber(iqr)))], handleSignals=False)
+    async def main():
+        serving = asyncio.ensure_future(server.serve())
+        while not server.listening.is_set():
+            await asyncio.sleep(0.01)
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        replies = []
+        for msgid, (cmd, args) in enumerate(requests, 1):
+            protocol.writeMessage(writer, protocol.request(msgid, cmd, **args))
+            while True:
+                msg = await protocol.readMessage(reader)
+                if msg["type"] == protocol.REPLY and msg["id"] == msgid:
+                    replies.append(msg)
+                    break
+        protocol.writeMessage(writer, protocol.request(0, protocol.CMD_KILL))
+        await serving
+        return replies
+    try:
+        return clock.run(main()), iqr.isOn()
+    finally:
+        control.destroy()
+
+
+def test_home_after_move_runs_again():
+    replies, on = run(True, [(protocol.CMD_HOME, {}),
+                             (protocol.CMD_MOVE, {"direction": "forward", "steps": 5}),
+                             (protocol.CMD_HOME, {})])
+    assert replies[1]["data"]["position"] == 5
+    assert not replies[2]["data"].get("coalesced")
+    assert replies[2]["data"]["position"] == 0
+
+
+def test_ensure_after_press_checks_again():
+    replies, on = run(False, [(protocol.CMD_ENSURE, {"power": "on"}),
+                              (protocol.CMD_PRESS, {"mode": "long"}),
+                              (protocol.CMD_ENSURE, {"power": "on"})])
+    assert replies[0]["data"]["changed"]
+    assert replies[1]["data"]["power"] == "off"
+    assert not replies[2]["data"].get("coalesced")
+    assert replies[2]["data"]["changed"]
+    assert on
+
+
+def test_noop_is_replayed_by_key():
+    # the status fills the cache, the first ensure is then answered at once
+    replies, on = run(False, [(protocol.CMD_STATUS, {}),
+                              (protocol.CMD_ENSURE, {"power": "off", "key": "k"}),
+                              (protocol.CMD_PRESS, {"mode": "short"}),
+                              (protocol.CMD_ENSURE, {"power": "off", "key": "k"})])
+    assert replies[1]["data"]["noop"]
+    assert replies[3]["data"]["noop"] and replies[3]["data"]["coalesced"]
+    assert on
+
+
+def test_duplicate_press_attaches():
+    replies, on = run(True, [(protocol.CMD_PRESS, {"mode": "long"}),
+                             (protocol.CMD_PRESS, {"mode": "long"})])
+    assert replies[1]["data"]["coalesced"]
+    assert not on
+
+
+def test_press_without_change_runs_again():
+    # held for less than the IQR needs, the press does not shut it down
+    replies, on = run(True, [(protocol.CMD_PRESS, {"mode": "long"}),
+                             (protocol.CMD_PRESS, {"mode": "long"})], longPress=10.)
+    assert replies[0]["data"]["changed"] is False
+    assert not replies[1]["data"].get("coalesced")